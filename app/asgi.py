@@ -0,0 +1,152 @@
+"""
+Asynchronous version of the app (see `main.py`), for serving at high
+concurrency. Run it with `scripts/serve.py`.
+"""
+
+from typing import Any, Awaitable, Dict, List
+import asyncio
+from loguru import logger
+from quart import Quart, Response, render_template, request, jsonify, abort
+from roam_sanity import config
+from roam_sanity.async_indexing import AsyncIndex
+from roam_sanity.cache import QueryCache
+from roam_sanity.queries import SearchArgs
+from roam_sanity.rendering import (format_result, format_long_content,
+                                   RESULT_FIELDS, LONG_CONTENT_FIELDS)
+from roam_sanity.util import hash_
+
+RESULTS_BATCH_SIZE = 50
+DOC_MAX_AGE = 3600
+VERSION_CHECK_INTERVAL = 5
+
+app = Quart(__name__)
+index = AsyncIndex(config.INDEX_NAME)
+
+# The index version is polled in the background, not on the request path
+state = {'version': None}  # type: Dict[str, Any]
+cache = QueryCache.from_env(version_fn=lambda: state['version'])
+
+# Identical searches being computed, so concurrent requests share them
+in_flight = {}  # type: Dict[str, asyncio.Future]
+
+
+async def poll_index_version():
+    while True:
+        try:
+            state['version'] = await index.build_id()
+        except Exception as e:
+            logger.warning(f"Can't get index version: {e}")
+        await asyncio.sleep(VERSION_CHECK_INTERVAL)
+
+
+@app.before_serving
+async def startup():
+    app.config['version_poller'] = asyncio.ensure_future(poll_index_version())
+
+
+@app.after_serving
+async def shutdown():
+    app.config['version_poller'].cancel()
+    await index.close()
+
+
+@app.route('/')
+async def render_index():
+    return await render_template('index.html')
+
+
+@app.route('/about')
+async def render_about():
+    return await render_template('about.html')
+
+
+async def search_page(args: SearchArgs) -> Dict:
+    query, cursor, sort, filters = args
+    key = cache.make_key(query, cursor=cursor, filters=filters, sort=sort)
+    page = cache.get(key)
+    if page is not None:
+        return page
+
+    if key in in_flight:
+        return await asyncio.shield(in_flight[key])
+
+    future = asyncio.get_event_loop().create_future()  # type: asyncio.Future
+    in_flight[key] = future
+    try:
+        requests = [index.search_page(query, k=RESULTS_BATCH_SIZE,
+                                      cursor=cursor, fields=RESULT_FIELDS,
+                                      filters=filters,
+                                      sort=sort)]  # type: List[Awaitable[Any]]
+        # Counts per source are only needed with the first page
+        if not cursor:
+            requests.append(index.facets(query, filters))
+        res = await asyncio.wait_for(asyncio.gather(*requests),
+                                     timeout=config.REQUEST_TIMEOUT)
+        hits, next_cursor = res[0]
+        page = {'hits': hits, 'cursor': next_cursor,
+                'facets': None if cursor else res[1]}
+        cache.set(key, page)
+        future.set_result(page)
+        return page
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # Mark as retrieved if nobody else is waiting
+        raise
+    except BaseException:
+        future.cancel()
+        raise
+    finally:
+        del in_flight[key]
+
+
+@app.route('/search')
+async def search():
+    try:
+        page = await search_page(SearchArgs.parse(request.args))
+    except ValueError:
+        abort(400)
+    except asyncio.TimeoutError:
+        abort(504)
+
+    res = [e[1] for e in page['hits']]
+    res_html = '\n'.join([format_result(e) for e in res])
+    return jsonify(html=res_html, n_results=len(res), cursor=page['cursor'],
+                   facets=page['facets'])
+
+
+@app.route('/doc/<doc_id>')
+async def get_doc(doc_id: str):
+    try:
+        doc = await asyncio.wait_for(
+            index.get_by_id(doc_id, fields=LONG_CONTENT_FIELDS),
+            timeout=config.REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        abort(504)
+    if doc is None:
+        return jsonify(error=f'No document `{doc_id}`'), 404
+
+    html = format_long_content(doc)
+    etag = hash_(html)
+    if request.if_none_match.contains(etag):
+        response = Response('', status=304)
+    else:
+        response = jsonify(html=html)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = DOC_MAX_AGE
+    return response
+
+
+@app.route('/health')
+async def health():
+    try:
+        res = await asyncio.wait_for(index.health(),
+                                     timeout=config.REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        res = {'backend': 'elasticsearch', 'ready': False, 'error': 'Timeout'}
+    return jsonify(**res), 200 if res['ready'] else 503
+
+
+@app.route('/cache_stats')
+async def cache_stats():
+    return jsonify(**cache.stats())
@@ -1,15 +1,16 @@
-from typing import Dict
-import dateutil.parser
-from flask import Flask, render_template, request, jsonify
-from roam_sanity.indexing import index
+from flask import Flask, render_template, request, jsonify, abort
+from roam_sanity.backend import get_backend
+from roam_sanity.cache import QueryCache
+from roam_sanity.queries import SearchArgs
+from roam_sanity.rendering import (format_result, format_long_content,
+                                   RESULT_FIELDS, LONG_CONTENT_FIELDS)
 
-RESULTS_MAX = 1000
 RESULTS_BATCH_SIZE = 50
-
-N_CHARS_DISPLAYED_MAX = 150
-N_CHARS_ADDED_MIN = 150
+DOC_MAX_AGE = 3600
 
 app = Flask(__name__)
+index = get_backend()
+cache = QueryCache.from_env(version_fn=index.build_id)
 
 
 @app.route('/')
@@ -22,79 +23,56 @@ def render_about():
     return render_template('about.html')
 
 
-def format_result(raw: Dict) -> str:
-    content_short = raw['text']
-    content_long = raw['text']
-
-    if raw['source'] == 'roam-research':
-        title = f"/{raw['database']} {raw['title']}"
-        content_short = ''
-        time_iso = raw['edit_time'] if 'edit_time' in raw else raw['create_time']
-
-    elif raw['source'] == 'twitter':
-        title = f"@{raw['author_screen_name']}"
-        time_iso = raw['create_time']
-
-    elif raw['source'] == 'slack':
-        title = f"#{raw['channel']}"
-        time_iso = raw['create_time']
-
-        # Display only the first message
-        thread_start = raw['text'].find('<NEXT_MESSAGE>')
-        if thread_start > -1:
-            content_short = raw['text'][:thread_start]
-            content_long = content_long.replace('<NEXT_MESSAGE>',
-                                                '<div class="message_sep">-----</div>')
-
-        if 'url' not in raw:
-            raw['url'] = ''
-
-    if len(content_short) > N_CHARS_DISPLAYED_MAX + N_CHARS_ADDED_MIN:
-        content_short = content_short[:N_CHARS_DISPLAYED_MAX] + '...'
-
-    time = dateutil.parser.parse(time_iso).strftime('%m/%d/%y')
-
-    if content_long != content_short:
-        html_content_long = f'''
-            <a class='show_more'>[more]</a>
-            <div class='content long'>
-                {content_long}
-            </div>
-            <a class='show_less'>[less]</a>
-        '''
-    else:
-        html_content_long = ''
-
-    html = f'''
-        <div class='search_result'>
-            <a href="{raw['url']}" target='_blank'
-               class='title{" link_missing" if not raw["url"] else ""}'>
-                <img src="static/img/{raw['source']}.png" alt="{raw['source']}">
-                {title}
-            </a>
-            <span class='time'>({time})</span>
-            <div class='content short'>
-                {content_short}
-            </div>
-            {html_content_long}
-        </div>
-    '''
-    return html
-
-
 @app.route('/search')
 def search():
-    query = request.args.get('query', 0, type=str)
-    offset = request.args.get('offset', 0, type=int)
+    try:
+        query, cursor, sort, filters = SearchArgs.parse(request.args)
+    except ValueError:
+        abort(400)
+
+    def _search():
+        hits, next_cursor = index.search_page(query, k=RESULTS_BATCH_SIZE,
+                                              cursor=cursor,
+                                              fields=RESULT_FIELDS,
+                                              filters=filters, sort=sort)
+        # Counts per source are only needed with the first page
+        facets = None if cursor else index.facets(query, filters)
+        return {'hits': hits, 'cursor': next_cursor, 'facets': facets}
+
+    try:
+        page = cache.get_or_compute(query, _search, cursor=cursor,
+                                    filters=filters, sort=sort)
+    except ValueError:
+        abort(400)
+
+    res = [e[1] for e in page['hits']]
+    res_html = '\n'.join([format_result(e) for e in res])
+    return jsonify(html=res_html, n_results=len(res), cursor=page['cursor'],
+                   facets=page['facets'])
 
-    if offset >= RESULTS_MAX:
-        return jsonify(html='', n_results=0)
 
-    k = min(RESULTS_MAX, offset+RESULTS_BATCH_SIZE)
-    res = [e[1] for e in index.search(query, k=k)[offset:]]
-    res_html = '\n'.join([format_result(e) for e in res])
+@app.route('/doc/<doc_id>')
+def get_doc(doc_id: str):
+    doc = index.get_by_id(doc_id, fields=LONG_CONTENT_FIELDS)
+    if doc is None:
+        return jsonify(error=f'No document `{doc_id}`'), 404
+
+    response = jsonify(html=format_long_content(doc))
+    response.cache_control.public = True
+    response.cache_control.max_age = DOC_MAX_AGE
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@app.route('/health')
+def health():
+    res = index.health()
+    return jsonify(**res), 200 if res['ready'] else 503
+
 
-    return jsonify(html=res_html, n_results=len(res))
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify(**cache.stats())
 
 
 if __name__ == '__main__':
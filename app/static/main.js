@@ -1,5 +1,7 @@
 var query = ''
+var source = ''
 var n_results = 0
+var cursor = null
 var search_in_progress = false
 var search_completed = false
 
@@ -11,13 +13,28 @@ function search() {
     search_in_progress = true
     // $('#loading_spinner').css('display', 'block')
 
-    $.getJSON($SCRIPT_ROOT + '/search', {
-        query: query,
-        offset: n_results
-    }, function(data) {
+    var params = {query: query}
+    if (cursor)
+        params['cursor'] = cursor
+    if (source)
+        params['source'] = source
+    params['sort'] = $('#sort').val()
+    // Until is inclusive in the UI
+    if ($('#since').val())
+        params['since'] = $('#since').val()
+    if ($('#until').val()) {
+        var until = new Date($('#until').val())
+        until.setUTCDate(until.getUTCDate() + 1)
+        params['until'] = until.toISOString().slice(0, 10)
+    }
+
+    $.getJSON($SCRIPT_ROOT + '/search', params, function(data) {
         n_results += data['n_results']
+        cursor = data['cursor']
+        if (data['facets'])
+            show_facets(data['facets'])
         $('#search_results').append(data['html']);
-        if (data['n_results'] == 0)
+        if (!cursor)
             search_completed = true
         // $('#loading_spinner').hide()
     }).always(function() {
@@ -27,28 +44,53 @@ function search() {
 }
 
 
+function show_facets(facets) {
+    $('#facets').empty()
+    $.each(facets, function(name, count) {
+        var facet = $('<span class="facet"></span>')
+            .text(name + ' (' + count + ')')
+            .data('source', name)
+        if (name == source)
+            facet.addClass('selected')
+        $('#facets').append(facet)
+    })
+}
+
+
+function new_search() {
+    n_results = 0
+    cursor = null
+    search_completed = false
+    $('#search_results').empty();
+    query = $('#search_bar input').val()
+    search()
+}
+
+
 $(document).ready(function() {
     const textField = new mdc.textField.MDCTextField(document.querySelector('.mdc-text-field'));
     textField.focus();
 
     $('#search_bar').on('keyup', function (e) {
         if (e.key === 'Enter' || e.keyCode === 13) {
-            n_results = 0
-            search_completed = false
-          $('#search_results').empty();
-          query = $('#search_bar input').val()
-          search()
+            new_search()
         }
     });
 
     $('#search_button').click(function() {
-      n_results = 0
-      search_completed = false
-      $('#search_results').empty();
-      query = $('#search_bar input').val()
-      search()
+      new_search()
     });
 
+    // filters
+    $(document).on('click', '.facet', function() {
+        var name = $(this).data('source')
+        source = (source == name) ? '' : name
+        new_search()
+    })
+    $('#sort, #since, #until').on('change', function() {
+        new_search()
+    })
+
     // inifinite scrolling
     $(window).on('scroll', function(){
         if (n_results == 0)
@@ -64,10 +106,24 @@ $(document).ready(function() {
 
     // show more / show less
     $(document).on('click', '.search_result .show_more', function() {
-        $(this).hide()
-        $(this).parent().find('.content.short').hide()
-        $(this).parent().find('.content.long').show()
-        $(this).parent().find('.show_less').css({'display': 'block'})
+        var result = $(this).parent()
+        var show = function() {
+            result.find('.show_more').hide()
+            result.find('.content.short').hide()
+            result.find('.content.long').show()
+            result.find('.show_less').css({'display': 'block'})
+        }
+
+        // Long contents are loaded on demand
+        if (result.data('loaded')) {
+            show()
+            return
+        }
+        $.getJSON($SCRIPT_ROOT + '/doc/' + result.data('doc-id'), function(data) {
+            result.find('.content.long').html(data['html'])
+            result.data('loaded', true)
+            show()
+        })
     })
     $(document).on('click', '.search_result .show_less', function() {
         $(this).hide()
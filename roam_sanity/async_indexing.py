@@ -0,0 +1,118 @@
+"""Read-only access to the index, with the asynchronous Elasticsearch client"""
+
+from typing import Any, Dict, List, Optional, Tuple
+import time
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.exceptions import NotFoundError
+from roam_sanity import config
+from roam_sanity.queries import (Hits, SearchFilters, SORT_RELEVANCE,
+                                 SORT_BOOSTED, COLLAPSE_FIELD,
+                                 MAPPING_CHECK_INTERVAL, build_search_body,
+                                 parse_search_response, build_facets_body,
+                                 parse_facets_response, recency_origin,
+                                 supports_collapse, parse_build_id)
+
+
+class AsyncIndex:
+    """Asynchronous counterpart of `indexing._Index`, for serving.
+    The client keeps a pool of `config.ES_MAXSIZE` connections per host."""
+    def __init__(self, name: str):
+        self.name = name
+        self._client = None  # type: Optional[AsyncElasticsearch]
+        self._collapse = False
+        self._collapse_checked_at = None  # type: Optional[float]
+
+    @property
+    def es_client(self) -> AsyncElasticsearch:
+        if self._client is None:
+            self._client = AsyncElasticsearch(
+                config.ES_HOSTS,
+                maxsize=config.ES_MAXSIZE,
+                timeout=config.ES_TIMEOUT,
+                retry_on_timeout=True,
+                max_retries=1,
+            )
+        return self._client
+
+    async def health(self) -> Dict[str, Any]:
+        try:
+            ready = bool(await self.es_client.ping())
+            error = None if ready else "Can't ping Elasticsearch"
+        except Exception as e:
+            ready, error = False, repr(e)
+        return {'backend': 'elasticsearch', 'ready': ready, 'error': error}
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    async def _supports_collapse(self) -> bool:
+        """See `indexing._Index._supports_collapse`"""
+        now = time.time()
+        if self._collapse_checked_at is None \
+                or now - self._collapse_checked_at >= MAPPING_CHECK_INTERVAL:
+            try:
+                res = await self.es_client.indices.get_field_mapping(
+                    fields=COLLAPSE_FIELD, index=self.name)
+            except NotFoundError:
+                res = {}
+            self._collapse = supports_collapse(res)
+            self._collapse_checked_at = now
+        return self._collapse
+
+    async def search_page(self, query: str, k: int,
+                          cursor: Optional[str] = None,
+                          fields: Optional[List[str]] = None,
+                          filters: Optional[SearchFilters] = None,
+                          sort: str = SORT_RELEVANCE
+                          ) -> Tuple[Hits, Optional[str]]:
+        """See `backend.SearchBackend.search_page`"""
+        origin = recency_origin(cursor) if sort == SORT_BOOSTED else None
+        body = build_search_body(query, k, cursor, fields, filters, sort,
+                                 origin, await self._supports_collapse())
+        try:
+            res = await self.es_client.search(index=self.name, body=body)
+        except NotFoundError:
+            # No index yet
+            return [], None
+        return parse_search_response(res, k, origin, body.get('from'))
+
+    async def facets(self, query: str, filters: Optional[SearchFilters] = None
+                     ) -> Dict[str, int]:
+        """See `backend.SearchBackend.facets`"""
+        collapse = await self._supports_collapse()
+        try:
+            res = await self.es_client.search(
+                index=self.name,
+                body=build_facets_body(query, filters, collapse))
+        except NotFoundError:
+            # No index yet
+            return {}
+        return parse_facets_response(res)
+
+    async def get_by_id(self, id_: str,
+                        fields: Optional[List[str]] = None) -> Optional[Dict]:
+        kwargs = {} if fields is None \
+            else {'_source_includes': fields}  # type: Dict[str, Any]
+        try:
+            res = await self.es_client.get(index=self.name, id=id_, **kwargs)
+        except NotFoundError:
+            return None
+        return res['_source']
+
+    async def current_version(self) -> Optional[str]:
+        """Returns the index version the alias points to"""
+        try:
+            res = await self.es_client.indices.get_alias(name=self.name)
+        except NotFoundError:
+            return None
+        return next(iter(res))
+
+    async def build_id(self) -> Optional[str]:
+        """See `indexing._Index.build_id`"""
+        try:
+            res = await self.es_client.indices.get_mapping(index=self.name)
+        except NotFoundError:
+            return None
+        return parse_build_id(res)
@@ -0,0 +1,19 @@
+"""Selection of the search backend"""
+
+from typing import Optional
+from pathlib import Path
+from roam_sanity import config
+from roam_sanity.interface import SearchBackend
+
+
+def get_backend(name: Optional[str] = None) -> SearchBackend:
+    """Returns the backend `name`, or the one set in `config.BACKEND`.
+    Backends are imported on demand, so their dependencies are optional."""
+    name = name or config.BACKEND
+    if name == 'elasticsearch':
+        from roam_sanity.indexing import index  # pylint: disable=import-outside-toplevel
+        return index
+    if name == 'bm25':
+        from roam_sanity.bm25 import BM25Index  # pylint: disable=import-outside-toplevel
+        return BM25Index(Path(config.BM25_PATH))
+    raise ValueError(f'Unknown backend `{name}`')
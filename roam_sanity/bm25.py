@@ -0,0 +1,696 @@
+"""
+Embedded search backend, running in-process instead of Elasticsearch.
+
+Documents are indexed in an inverted index scored with BM25, using the same
+analysis as `indexing.ANALYZER_SETTINGS` (standard tokenization, lowercase,
+Porter stemming and ASCII folding). Postings are stored as NumPy arrays,
+memory-mapped from disk.
+
+Like Elasticsearch builds, each build writes a new version of the index in
+its own folder, and then switches the `CURRENT` pointer to it atomically.
+
+Hits are collapsed by page, like `queries.build_search_body`: documents are
+grouped by the hash of their `page_url`.
+
+Requires the `embedded` extra dependencies: `pip install -U -e .[embedded]`
+"""
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+import os
+import re
+import json
+import math
+import mmap
+import shutil
+import time
+import threading
+import unicodedata
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+import Stemmer
+from loguru import logger
+from tqdm import tqdm
+from roam_sanity.interface import SearchBackend, BulkReport
+from roam_sanity.loading import load_in_parallel, prepare_doc
+from roam_sanity.queries import (Hits, SearchFilters, N_FACETS_MAX,
+                                 N_BLOCKS_MAX, SORT_RELEVANCE, SORT_RECENT, SORT_BOOSTED,
+                                 RECENCY_SCALE, RECENCY_DECAY, check_sort,
+                                 recency_origin, encode_cursor, decode_cursor)
+from roam_sanity.util import get_by_extension, doc_id, hash_, json_loads
+from roam_sanity.corpus import SegmentStore
+
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+CURRENT_FILENAME = 'CURRENT'
+MAX_TF = np.iinfo(np.uint16).max
+
+
+def fold_ascii(token: str) -> str:
+    """Equivalent of the `asciifolding` filter"""
+    try:
+        token.encode('ascii')
+        return token
+    except UnicodeEncodeError:
+        decomposed = unicodedata.normalize('NFKD', token)
+        return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def _group_id(doc: Dict) -> str:
+    """Id of the page of a prepared document (its own id if it isn't a
+    block)"""
+    if doc.get('page_url'):
+        return hash_(doc['page_url'])
+    return doc['doc_id']
+
+
+class Analyzer:
+    """Equivalent of the `tags_analyzer` of `indexing.ANALYZER_SETTINGS`"""
+    def __init__(self):
+        self._stemmer = Stemmer.Stemmer('porter')
+
+    def __call__(self, text: str) -> List[str]:
+        tokens = TOKEN_RE.findall(text.lower())
+        return [fold_ascii(t) for t in self._stemmer.stemWords(tokens)]
+
+
+class _Segment:  # pylint: disable=too-many-instance-attributes
+    """Immutable version of the index, memory-mapped from a folder (empty
+    without `path`), and the documents added since it was built, by id.
+    Documents are numbered in the order of their ids. Files are unmapped
+    once the segment is garbage-collected."""
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+        self.version = path.name if path is not None else None
+        self.pending = {}  # type: Dict[str, Dict]
+        if path is None:
+            self._init_empty()
+            return
+
+        with open(path / 'meta.json', 'r') as f:
+            meta = json.load(f)
+        self.n_docs = meta['n_docs']
+        self.avg_length = meta['avg_length']
+        self.sources = meta.get('sources', [])  # type: List[str]
+        with open(path / 'terms.json', 'r') as f:
+            self.terms = json.load(f)  # type: Dict[str, int]
+
+        def _load(name: str) -> np.ndarray:
+            # Plain array views are faster to index than `np.memmap`
+            return np.load(path / f'{name}.npy', mmap_mode='r') \
+                .view(np.ndarray)
+
+        self.term_offsets = _load('term_offsets')
+        self.postings_docs = _load('postings_docs')
+        self.postings_tfs = _load('postings_tfs')
+        self.doc_lengths = _load('doc_lengths')
+        self.doc_ids = _load('doc_ids')
+        self.doc_offsets = _load('doc_offsets')
+
+        # The mapping keeps its own file descriptor
+        with open(path / 'docs.jsonl', 'rb') as docs_file:
+            self._docs = mmap.mmap(docs_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ) \
+                if self.n_docs else b''  # type: Union[mmap.mmap, bytes]
+
+        # Filtered fields (NaN if there is no timestamp)
+        if (path / 'doc_sources.npy').is_file():
+            self.doc_sources = _load('doc_sources')
+            self.doc_timestamps = _load('doc_timestamps')
+        else:
+            # Written before filters were supported
+            docs = list(self.docs())
+            self.sources = sorted({doc['source'] for doc in docs})
+            self.doc_sources = np.array(
+                [self.sources.index(doc['source']) for doc in docs],
+                dtype=np.int32)
+            self.doc_timestamps = np.array(
+                [doc.get('timestamp') for doc in docs], dtype=np.float64)
+
+        # Pages, numbered in the order of their ids
+        if (path / 'doc_groups.npy').is_file():
+            self.group_ids = _load('group_ids')
+            self.doc_groups = _load('doc_groups')
+        else:
+            # Written before blocks were collapsed: a page per document
+            self.group_ids = self.doc_ids
+            self.doc_groups = np.arange(self.n_docs, dtype=np.int32)
+        # Whether the page of each document has other documents, as only
+        # those need collapsing
+        self.doc_shared = np.bincount(self.doc_groups)[self.doc_groups] > 1
+
+    def _init_empty(self):
+        self.n_docs = 0
+        self.avg_length = 0.
+        self.sources = []
+        self.terms = {}
+        self.term_offsets = np.zeros(1, dtype=np.int64)
+        self.postings_docs = np.empty(0, dtype=np.int32)
+        self.postings_tfs = np.empty(0, dtype=np.uint16)
+        self.doc_lengths = np.empty(0, dtype=np.uint32)
+        self.doc_ids = np.empty(0, dtype=str)
+        self.doc_offsets = np.zeros(1, dtype=np.int64)
+        self._docs = b''
+        self.doc_sources = np.empty(0, dtype=np.int32)
+        self.doc_timestamps = np.empty(0, dtype=np.float64)
+        self.group_ids = np.empty(0, dtype=str)
+        self.doc_groups = np.empty(0, dtype=np.int32)
+        self.doc_shared = np.empty(0, dtype=bool)
+
+    def filter_mask(self, nums: np.ndarray,
+                    filters: SearchFilters) -> np.ndarray:
+        """Returns which documents match `filters`, from their numbers"""
+        keep = np.ones(len(nums), dtype=bool)
+        if filters.sources:
+            codes = [i for i, source in enumerate(self.sources)
+                     if source in filters.sources]
+            keep &= np.isin(self.doc_sources[nums], codes)
+        timestamps = self.doc_timestamps[nums]
+        # Comparisons with NaN are false, so documents without a timestamp
+        # are excluded by time ranges
+        if filters.since is not None:
+            keep &= timestamps >= filters.since
+        if filters.until is not None:
+            keep &= timestamps < filters.until
+        return keep
+
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        term_id = self.terms.get(term)
+        if term_id is None:
+            return np.empty(0, np.int32), np.empty(0, np.uint16)
+        lo, hi = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+        return self.postings_docs[lo:hi], self.postings_tfs[lo:hi]
+
+    def find(self, id_: str) -> Optional[int]:
+        """Returns the number of a document, from its id"""
+        i = int(np.searchsorted(self.doc_ids, id_))
+        if i < self.n_docs and self.doc_ids[i] == id_:
+            return i
+        return None
+
+    def find_group(self, group_id: str) -> Optional[int]:
+        """Returns the number of a page, from its id"""
+        i = int(np.searchsorted(self.group_ids, group_id))
+        if i < len(self.group_ids) and self.group_ids[i] == group_id:
+            return i
+        return None
+
+    def position_after(self, id_: str) -> int:
+        """Returns the number of the first document whose id is after `id_`"""
+        return int(np.searchsorted(self.doc_ids, id_, side='right'))
+
+    def doc(self, i: int) -> Dict:
+        return json_loads(self._docs[self.doc_offsets[i]:
+                                     self.doc_offsets[i + 1]])
+
+    def docs(self) -> Iterator[Dict]:
+        for i in range(self.n_docs):
+            yield self.doc(i)
+
+
+def write_segment(path: Path, docs: Iterator[Dict], analyzer: Analyzer,
+                  report: Optional[BulkReport] = None):
+    """Indexes prepared documents (see `loading.prepare_doc`) into a folder"""
+    path.mkdir(parents=True)
+
+    # Documents are first written in arrival order, and then sorted by id
+    terms = {}  # type: Dict[str, int]
+    postings = []  # type: List[Tuple[List[int], List[int]]]
+    ids = []  # type: List[str]
+    lengths = []  # type: List[int]
+    sources = {}  # type: Dict[str, int]
+    doc_sources = []  # type: List[int]
+    groups = []  # type: List[str]
+    timestamps = []  # type: List[Optional[float]]
+    offsets = [0]
+    raw_docs_path = path / 'docs.unsorted'
+    with open(raw_docs_path, 'wb') as f:
+        for doc in docs:
+            num = len(ids)
+            tokens = analyzer(doc['text'])
+            for term, tf in Counter(tokens).items():
+                term_id = terms.setdefault(term, len(terms))
+                if term_id == len(postings):
+                    postings.append(([], []))
+                postings[term_id][0].append(num)
+                postings[term_id][1].append(tf)
+
+            ids.append(doc['doc_id'])
+            lengths.append(len(tokens))
+            doc_sources.append(sources.setdefault(doc['source'], len(sources)))
+            groups.append(_group_id(doc))
+            timestamps.append(doc.get('timestamp'))
+            f.write(json.dumps(doc).encode('utf-8'))
+            offsets.append(f.tell())
+            if report is not None:
+                report.n_indexed += 1
+
+    order = np.argsort(np.array(ids, dtype=str), kind='stable')
+    new_nums = np.empty(len(ids), dtype=np.int32)
+    new_nums[order] = np.arange(len(ids), dtype=np.int32)
+
+    # Postings, concatenated term after term
+    term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    for term_id, (nums, _) in enumerate(postings):
+        term_offsets[term_id + 1] = term_offsets[term_id] + len(nums)
+    postings_docs = np.empty(term_offsets[-1], dtype=np.int32)
+    postings_tfs = np.empty(term_offsets[-1], dtype=np.uint16)
+    for term_id, (nums, tfs) in enumerate(postings):
+        lo, hi = term_offsets[term_id], term_offsets[term_id + 1]
+        docs_ = new_nums[np.array(nums, dtype=np.int32)]
+        tfs_ = np.minimum(np.array(tfs, dtype=np.int64), MAX_TF)
+        by_doc = np.argsort(docs_)
+        postings_docs[lo:hi] = docs_[by_doc]
+        postings_tfs[lo:hi] = tfs_[by_doc]
+
+    # Documents, sorted by id
+    doc_offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    with open(raw_docs_path, 'rb') as f_in, \
+            open(path / 'docs.jsonl', 'wb') as f_out:
+        for new_num, num in enumerate(order):
+            f_in.seek(offsets[num])
+            f_out.write(f_in.read(offsets[num + 1] - offsets[num]))
+            doc_offsets[new_num + 1] = f_out.tell()
+    raw_docs_path.unlink()
+
+    np.save(path / 'term_offsets.npy', term_offsets)
+    np.save(path / 'postings_docs.npy', postings_docs)
+    np.save(path / 'postings_tfs.npy', postings_tfs)
+    np.save(path / 'doc_lengths.npy',
+            np.array(lengths, dtype=np.uint32)[order])
+    np.save(path / 'doc_ids.npy', np.array(ids, dtype=str)[order])
+    np.save(path / 'doc_offsets.npy', doc_offsets)
+    np.save(path / 'doc_sources.npy',
+            np.array(doc_sources, dtype=np.int32)[order])
+    np.save(path / 'doc_timestamps.npy',
+            np.array(timestamps, dtype=np.float64)[order])
+    group_ids, doc_groups = np.unique(np.array(groups, dtype=str),
+                                      return_inverse=True)
+    np.save(path / 'group_ids.npy', group_ids)
+    np.save(path / 'doc_groups.npy', doc_groups.astype(np.int32)[order])
+    with open(path / 'terms.json', 'w') as f:
+        json.dump(terms, f)
+    with open(path / 'meta.json', 'w') as f:
+        json.dump({
+            'n_docs': len(ids),
+            'avg_length': float(np.mean(lengths)) if lengths else 0.,
+            'sources': sorted(sources, key=sources.__getitem__),
+        }, f)
+
+
+def _sort_values(sort: str, scores: np.ndarray, timestamps: np.ndarray,
+                 origin: Optional[float] = None
+                 ) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the scores of hits and the values they are sorted by, in
+    decreasing order. Like Elasticsearch, documents without a timestamp are
+    last when sorting by recency, and aren't affected by the recency boost."""
+    missing = np.isnan(timestamps)
+    if sort == SORT_RECENT:
+        return scores, np.where(missing, -np.inf, timestamps)
+    if sort == SORT_BOOSTED and origin is not None:
+        ages = np.abs(origin - np.where(missing, origin, timestamps))
+        scores = scores * RECENCY_DECAY ** (ages / RECENCY_SCALE)
+    return scores, scores
+
+
+def _parse_cursor(cursor: str) -> Tuple[float, str]:
+    """Returns the value and the id of the last hit of the previous page.
+    Raises ValueError if the cursor is invalid."""
+    sort_values = decode_cursor(cursor)
+    try:
+        return (-np.inf if sort_values[0] is None else float(sort_values[0]),
+                str(sort_values[1]))
+    except (IndexError, TypeError, ValueError) as e:
+        raise ValueError(f'Invalid cursor: {cursor}') from e
+
+
+def _follow(values: np.ndarray, docs: np.ndarray,
+            after: Optional[Tuple[float, int]] = None
+            ) -> Union[np.ndarray, slice]:
+    """Which hits follow the last one of the previous page, from its value
+    and the number of the first document after its id (all without it)"""
+    if after is None:
+        return slice(None)
+    value, num = after
+    return (values < value) | ((values == value) & (docs >= num))
+
+
+def _select(doc: Dict, fields: Optional[List[str]] = None) -> Dict:
+    if fields is None:
+        return doc
+    return {k: doc[k] for k in fields if k in doc}
+
+
+class BM25Index(SearchBackend):
+    """Search backend running in-process, from the index built in `path`.
+    Documents added with `add` are kept in memory until the next build."""
+    def __init__(self, path: Path, k1: float = 1.2, b: float = 0.75,
+                 reload_interval: float = 1.):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.reload_interval = reload_interval
+        self.analyzer = Analyzer()
+
+        # Time of the last check of the current version, and its segment
+        self._loaded = (0., None)  # type: Tuple[float, Optional[_Segment]]
+        self._lock = threading.Lock()
+
+    def current_version(self) -> Optional[str]:
+        try:
+            with open(self.path / CURRENT_FILENAME, 'r') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def health(self) -> Dict[str, Any]:
+        version = self.current_version()
+        return {
+            'backend': 'bm25',
+            'ready': version is not None,
+            'error': None if version else f'No index in `{self.path}`',
+        }
+
+    @property
+    def segment(self) -> _Segment:
+        """Loads the current version, and reloads it after a rebuild (the
+        index is empty until the first one). Requests use the segment they
+        started with, even if it is replaced in the meantime."""
+        with self._lock:
+            now = time.time()
+            checked_at, segment = self._loaded
+            if segment is None or now - checked_at >= self.reload_interval:
+                version = self.current_version()
+                if segment is None or segment.version != version:
+                    segment = _Segment(self.path / version
+                                       if version else None)
+                self._loaded = (now, segment)
+            return segment
+
+    def populate(self, data_path: Path, n_loaders: Optional[int] = None,
+                 incremental: bool = False, retention: int = 2,
+                 **kwargs) -> BulkReport:
+        """Builds a new version of the index from JSON files and corpus
+        segments, then switches to it. Only the `retention` latest versions are kept."""
+        if incremental:
+            logger.warning('Incremental builds are not supported by the '
+                           'embedded backend, rebuilding everything')
+
+        report = BulkReport()
+
+        def _docs() -> Iterator[Dict]:
+            paths = get_by_extension(data_path, 'json')
+            chunks = SegmentStore(data_path).iter_chunks()
+            for loaded in tqdm(load_in_parallel(paths, n_loaders,
+                                                chunks=chunks), unit='doc'):
+                if loaded.error is not None:
+                    report.add_failure(loaded.path, loaded.error)
+                    continue
+                yield loaded.doc  # type: ignore
+
+        version = self._write_version(_docs(), report)
+        self._switch(version)
+        self._delete_old_versions(retention)
+
+        report.end_time = time.time()
+        return report
+
+    def _write_version(self, docs: Iterator[Dict],
+                       report: Optional[BulkReport] = None) -> str:
+        version = f"bm25_{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}"
+        logger.info(f'Writing `{version}`')
+        write_segment(self.path / version, docs, self.analyzer, report)
+        return version
+
+    def _switch(self, version: str):
+        """Points the index to `version`, atomically"""
+        tmp_path = self.path / f'{CURRENT_FILENAME}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(version)
+        os.replace(tmp_path, self.path / CURRENT_FILENAME)
+        with self._lock:
+            self._loaded = (0., self._loaded[1])
+        logger.info(f'`{self.path}` now points to `{version}`')
+
+    def versions(self) -> List[str]:
+        """Returns index versions, from the oldest to the newest"""
+        return sorted(p.name for p in self.path.glob('bm25_*') if p.is_dir())
+
+    def _delete_old_versions(self, retention: int):
+        current = self.current_version()
+        old = [v for v in self.versions() if v != current]
+        for version in old[:max(0, len(old) - max(0, retention - 1))]:
+            logger.info(f'Deleting `{version}`')
+            shutil.rmtree(self.path / version)
+
+    def add(self, doc: Dict):
+        prepared = prepare_doc(doc)
+        self.segment.pending[prepared['doc_id']] = prepared
+
+    def get(self, **kwargs) -> List[Dict]:
+        if set(kwargs) == {'url'}:
+            doc = self.get_by_id(doc_id(kwargs))
+            return [doc] if doc is not None else []
+
+        # Full scan
+        segment = self.segment
+        pending = list(segment.pending.values())
+        return [doc for doc in list(segment.docs()) + pending
+                if all(doc.get(k) == v for k, v in kwargs.items())]
+
+    def get_by_id(self, id_: str,
+                  fields: Optional[List[str]] = None) -> Optional[Dict]:
+        segment = self.segment
+        pending = segment.pending.get(id_)
+        if pending is not None:
+            return _select(pending, fields)
+        num = segment.find(id_)
+        if num is None:
+            return None
+        return _select(segment.doc(num), fields)
+
+    def contains(self, doc: Dict) -> bool:
+        return self.get_by_id(doc_id(doc), fields=[]) is not None
+
+    def _score(self, segment: _Segment,
+               terms: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the numbers and BM25 scores of matching documents"""
+        n_docs = segment.n_docs
+        all_docs = []
+        all_scores = []
+        for term in terms:
+            docs, tfs = segment.postings(term)
+            if not len(docs):
+                continue
+            idf = math.log(1 + (n_docs - len(docs) + .5) / (len(docs) + .5))
+            tfs = tfs.astype(np.float64)
+            norms = self.k1 * (1 - self.b + self.b * segment.doc_lengths[docs]
+                               / segment.avg_length)
+            all_docs.append(docs)
+            all_scores.append(idf * tfs / (tfs + norms))
+
+        if not all_docs:
+            return np.empty(0, np.int32), np.empty(0, np.float64)
+        if len(all_docs) == 1:
+            return np.asarray(all_docs[0]), all_scores[0]
+
+        docs, inverse = np.unique(np.concatenate(all_docs),
+                                  return_inverse=True)
+        return docs, np.bincount(inverse, weights=np.concatenate(all_scores))
+
+    def _score_pending(self, segment: _Segment, terms: List[str],
+                       filters: Optional[SearchFilters] = None
+                       ) -> List[Tuple[float, str]]:
+        """Scores documents added since the build, with the build's
+        statistics"""
+        pending = list(segment.pending.items())
+        n_docs = segment.n_docs + len(pending)
+        avg_length = segment.avg_length or 1.
+        res = []
+        for id_, doc in pending:
+            if filters is not None and not filters.matches(doc):
+                continue
+            tokens = self.analyzer(doc['text'])
+            counts = Counter(tokens)
+            score = 0.
+            for term in terms:
+                if term not in counts:
+                    continue
+                df = len(segment.postings(term)[0]) + 1
+                idf = math.log(1 + (n_docs - df + .5) / (df + .5))
+                norm = self.k1 * (1 - self.b + self.b * len(tokens)
+                                  / avg_length)
+                score += idf * counts[term] / (counts[term] + norm)
+            if score > 0:
+                res.append((score, id_))
+        return res
+
+    def _matches(self, segment: _Segment, query: str,
+                 filters: Optional[SearchFilters] = None
+                 ) -> Tuple[np.ndarray, np.ndarray, List[Tuple[float, str]]]:
+        """Returns the numbers and scores of matching indexed documents,
+        and the scores and ids of matching documents added since the build"""
+        terms = self.analyzer(query)
+        docs, scores = self._score(segment, terms)
+        if filters is not None and len(docs):
+            keep = segment.filter_mask(docs, filters)
+            docs, scores = docs[keep], scores[keep]
+
+        # Documents added since the build replace indexed versions
+        pending = self._score_pending(segment, terms, filters) \
+            if segment.pending else []
+        if segment.pending and len(docs):
+            keep = ~np.isin(segment.doc_ids[docs], list(segment.pending))
+            docs, scores = docs[keep], scores[keep]
+        return docs, scores, pending
+
+    def _pending_groups(self, segment: _Segment, ids: List[str]) -> List[int]:
+        """Returns the page numbers of documents added since the build.
+        New pages are numbered after those of the build."""
+        new = {}  # type: Dict[str, int]
+        res = []
+        for id_ in ids:
+            group_id = _group_id(segment.pending[id_])
+            group = segment.find_group(group_id)
+            if group is None:
+                group = len(segment.group_ids) \
+                    + new.setdefault(group_id, len(new))
+            res.append(group)
+        return res
+
+    def _pending_hits(self, segment: _Segment, pending: List[Tuple[float, str]],
+                      sort: str, origin: Optional[float] = None,
+                      collapse: bool = True
+                      ) -> List[Tuple[float, str, float, int, int]]:
+        """Returns matching documents added since the build as (value, id,
+        score, -1, page number) tuples, in sort order. Pages are numbered
+        only if hits are collapsed."""
+        scores, values = _sort_values(
+            sort, np.array([s for s, _ in pending], dtype=np.float64),
+            np.array([segment.pending[id_].get('timestamp')
+                      for _, id_ in pending], dtype=np.float64), origin)
+        ids = [id_ for _, id_ in pending]
+        groups = self._pending_groups(segment, ids) if collapse \
+            else [-1] * len(ids)
+        return sorted(zip(values.tolist(), ids, scores.tolist(),
+                          [-1] * len(ids), groups),
+                      key=lambda e: (-e[0], e[1]))
+
+    def search_page(self, query: str, k: int, cursor: Optional[str] = None,
+                    fields: Optional[List[str]] = None,
+                    filters: Optional[SearchFilters] = None,
+                    sort: str = SORT_RELEVANCE) -> Tuple[Hits, Optional[str]]:
+        check_sort(sort)
+        origin = recency_origin(cursor) if sort == SORT_BOOSTED else None
+        last = _parse_cursor(cursor) if cursor else None
+        segment = self.segment
+        docs, scores, pending = self._matches(segment, query, filters)
+        scores, values = _sort_values(sort, scores,
+                                      segment.doc_timestamps[docs], origin)
+        after = None if last is None \
+            else (last[0], segment.position_after(last[1]))
+
+        # Like in Elasticsearch, hits sorted by recency aren't collapsed
+        collapse = sort != SORT_RECENT
+        pending_hits = self._pending_hits(segment, pending, sort, origin,
+                                          collapse)
+        pending_groups = [e[4] for e in pending_hits]
+
+        # Documents alone in their page (most sources) stand for it
+        shared = np.zeros(len(docs), dtype=bool)
+        if collapse:
+            shared = segment.doc_shared[docs]
+            if pending_hits:
+                shared |= np.isin(segment.doc_groups[docs], pending_groups)
+        alone = ~shared if shared.any() else slice(None)
+        alone_docs, alone_values = docs[alone], values[alone]
+        keep = _follow(alone_values, alone_docs, after)
+        alone_docs, alone_values = alone_docs[keep], alone_values[keep]
+        alone_scores = scores[alone][keep]
+        # Sort by value, then by id (documents are numbered in id order)
+        top = [(float(alone_values[i]), str(segment.doc_ids[alone_docs[i]]),
+                float(alone_scores[i]), int(alone_docs[i]), -1)
+               for i in np.lexsort((alone_docs, -alone_values))[:k]]
+
+        # Otherwise, the best hit of each page stands for it, wherever it is
+        shared = np.flatnonzero(shared)
+        shared = shared[np.lexsort((docs[shared], -values[shared]))]
+        groups = segment.doc_groups[docs[shared]]
+        best = np.sort(np.unique(groups, return_index=True)[1])
+        keep = np.ones(len(best), dtype=bool)
+        pending_best = []  # type: List[Tuple[float, str, float, int, int]]
+        for hit in pending_hits:
+            if collapse and any(e[4] == hit[4] for e in pending_best):
+                continue
+            i = np.flatnonzero(groups[best] == hit[4])
+            if len(i):
+                j = shared[best[i[0]]]
+                if (-values[j], str(segment.doc_ids[docs[j]])) \
+                        < (-hit[0], hit[1]):
+                    continue
+                keep[i[0]] = False
+            pending_best.append(hit)
+        best = best[keep]
+        best = best[_follow(values[shared[best]], docs[shared[best]], after)]
+        pending_best = [e for e in pending_best
+                        if last is None or (-e[0], e[1]) > (-last[0], last[1])]
+
+        top += [(float(values[j]), str(segment.doc_ids[docs[j]]),
+                 float(scores[j]), int(docs[j]), int(groups[i]))
+                for i, j in zip(best[:k], shared[best[:k]])]
+        top = sorted(top + pending_best, key=lambda e: (-e[0], e[1]))[:k]
+
+        def _doc(id_: str, num: int) -> Dict:
+            return _select(segment.doc(num) if num >= 0
+                           else segment.pending[id_], fields)
+
+        hits = []  # type: Hits
+        for _, id_, score, num, group in top:
+            doc = _doc(id_, num)
+            if group >= 0:
+                blocks = [(float(values[j]), str(segment.doc_ids[docs[j]]),
+                           int(docs[j]))
+                          for j in shared[groups == group][:N_BLOCKS_MAX]]
+                blocks += [e[:2] + (-1,) for e in pending_hits
+                           if e[4] == group]
+                if len(blocks) > 1:
+                    blocks = sorted(blocks, key=lambda e: (-e[0], e[1]))
+                    doc = {**doc, 'blocks': [_doc(id_, num) for _, id_, num
+                                             in blocks[:N_BLOCKS_MAX]]}
+            hits.append((score, doc))
+
+        next_cursor = None
+        if len(hits) == k:
+            value, id_ = top[-1][:2]
+            sort_values = [value if np.isfinite(value) else None, id_]
+            if origin is not None:
+                sort_values.append(origin)
+            next_cursor = encode_cursor(sort_values)
+        return hits, next_cursor
+
+    def facets(self, query: str,
+               filters: Optional[SearchFilters] = None) -> Dict[str, int]:
+        segment = self.segment
+        if filters is not None:
+            filters = filters._replace(sources=())
+        docs, _, pending = self._matches(segment, query, filters)
+        # Pages are counted once, from any of their documents
+        groups, first = np.unique(segment.doc_groups[docs], return_index=True)
+        counts = np.bincount(segment.doc_sources[docs[first]],
+                             minlength=len(segment.sources))
+        res = Counter({source: int(n)
+                       for source, n in zip(segment.sources, counts) if n})
+        pending_ids = [id_ for _, id_ in pending]
+        pending_groups = {
+            (segment.pending[id_]['source'], group) for id_, group
+            in zip(pending_ids, self._pending_groups(segment, pending_ids))}
+        known = set(groups.tolist())
+        res.update(source for source, group in pending_groups
+                   if group not in known)
+        return dict(res.most_common(N_FACETS_MAX))
+
+    def empty(self):
+        """Replaces the index by an empty version"""
+        self._switch(self._write_version(iter([])))
+        self._delete_old_versions(retention=1)
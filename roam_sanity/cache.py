@@ -0,0 +1,167 @@
+from typing import Any, Callable, Dict, Optional
+import os
+import re
+import json
+import time
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from roam_sanity.util import hash_
+
+
+def normalize_query(query: str) -> str:
+    return re.sub(r'\s+', ' ', query).strip().lower()
+
+
+class FileCacheBackend:
+    """Cache shared by the processes of a host, stored as one JSON file per
+    key. Values must be JSON-serializable."""
+    def __init__(self, dir_path: Path):
+        self.dir_path = dir_path
+        self.dir_path.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.dir_path / f'{hash_(key)}.json'
+
+    def get(self, key: str) -> Optional[Any]:
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if entry['key'] != key:
+            return None
+        if entry['expires_at'] < time.time():
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            return None
+        return entry['value']
+
+    def set(self, key: str, value: Any, ttl: float):
+        path = self._path(key)
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': key, 'expires_at': time.time() + ttl,
+                       'value': value}, f)
+        os.replace(tmp_path, path)
+
+
+class QueryCache:  # pylint: disable=too-many-instance-attributes
+    """LRU cache of search results, with a TTL.
+
+    Keys include the version of the index, given by `version_fn` (checked
+    at most every `version_check_interval` seconds), so entries are
+    invalidated as soon as the index is rebuilt."""
+    def __init__(self, max_size: int = 1024, ttl: float = 300.,
+                 backend: Optional[FileCacheBackend] = None,
+                 version_fn: Optional[Callable[[], Any]] = None,
+                 version_check_interval: float = 5.):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self.version_fn = version_fn
+        self.version_check_interval = version_check_interval
+
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # type: OrderedDict
+        self._lock = threading.Lock()
+        self._version = None  # type: Any
+        self._version_checked_at = 0.
+
+    @classmethod
+    def from_env(cls, version_fn: Optional[Callable[[], Any]] = None
+                 ) -> 'QueryCache':
+        """Reads settings from `RSP_CACHE_SIZE`, `RSP_CACHE_TTL` and
+        `RSP_CACHE_DIR` (directory of the cache shared between processes)"""
+        return cls(
+            max_size=int(os.environ.get('RSP_CACHE_SIZE', 1024)),
+            ttl=float(os.environ.get('RSP_CACHE_TTL', 300)),
+            backend=FileCacheBackend(Path(os.environ['RSP_CACHE_DIR']))
+            if 'RSP_CACHE_DIR' in os.environ else None,
+            version_fn=version_fn,
+        )
+
+    def _current_version(self) -> Any:
+        if self.version_fn is None:
+            return None
+
+        now = time.time()
+        if now - self._version_checked_at < self.version_check_interval:
+            return self._version
+
+        version = self.version_fn()
+        with self._lock:
+            self._version_checked_at = now
+            if version != self._version:
+                self._version = version
+                self._entries.clear()
+        return version
+
+    def make_key(self, query: str, **params) -> str:
+        return json.dumps([self._current_version(), normalize_query(query),
+                           params], sort_keys=True)
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at >= now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+        if self.backend is not None:
+            value = self.backend.get(key)
+            if value is not None:
+                self._set_local(key, value)
+                with self._lock:
+                    self.hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, value: Any):
+        self._set_local(key, value)
+        if self.backend is not None:
+            self.backend.set(key, value, self.ttl)
+
+    def _set_local(self, key: str, value: Any):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, query: str, compute: Callable[[], Any],
+                       **params) -> Any:
+        key = self.make_key(query, **params)
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            n_lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / n_lookups if n_lookups else 0.,
+                'size': len(self._entries),
+                'version': self._version,
+            }
@@ -0,0 +1,57 @@
+"""
+Progress of crawlers, so each run only fetches what is new since the last one.
+
+Checkpoints of a crawler are stored as a JSON object in
+`<data_path>/.rsp_checkpoints/<crawler>.json`, by query. Updates are kept in
+memory until `save`, so a crawler can save them once the documents they
+account for are saved. The folder is hidden, so it isn't taken for documents
+when the corpus is indexed (see `util.get_by_extension`).
+"""
+
+from typing import Any, Callable, Dict, Optional
+import os
+import json
+import threading
+from pathlib import Path
+
+
+CHECKPOINTS_DIRNAME = '.rsp_checkpoints'
+
+
+class Checkpoints:
+    """Checkpoints by key. Values must be JSON-serializable. Thread-safe."""
+    def __init__(self, path: Path):
+        self.path = path
+        self._values = {}  # type: Dict[str, Any]
+        self._lock = threading.Lock()
+        if path.is_file():
+            with open(path, 'r') as f:
+                self._values = json.load(f)
+
+    @classmethod
+    def for_crawler(cls, name: str) -> 'Checkpoints':
+        """Checkpoints of a crawler, in the corpus at `RSP_DATA_PATH`"""
+        return cls(Path(os.environ['RSP_DATA_PATH']) / CHECKPOINTS_DIRNAME
+                   / f'{name}.json')
+
+    def get(self, key: str, default: Optional[Any] = None) -> Optional[Any]:
+        with self._lock:
+            return self._values.get(key, default)
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._values[key] = value
+
+    def update(self, key: str, fn: Callable[[Optional[Any]], Any]):
+        """Replaces the value of `key` with `fn(value)` (None if there is no
+        value yet), atomically"""
+        with self._lock:
+            self._values[key] = fn(self._values.get(key))
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        with self._lock:
+            with open(tmp_path, 'w') as f:
+                json.dump(self._values, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
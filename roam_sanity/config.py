@@ -0,0 +1,27 @@
+"""Settings, read from environment variables"""
+
+import os
+
+
+# Search backend: `elasticsearch` or `bm25` (embedded, see `bm25.py`)
+BACKEND = os.environ.get('RSP_BACKEND', 'elasticsearch')
+
+INDEX_NAME = os.environ.get('RSP_INDEX_NAME', 'rsp')
+
+# Folder of the embedded index
+BM25_PATH = os.environ.get('RSP_BM25_PATH', 'bm25_index')
+
+# Comma-separated list of Elasticsearch hosts
+ES_HOSTS = os.environ.get('RSP_ES_HOSTS', 'localhost:9200').split(',')
+
+# Maximum number of connections per Elasticsearch host
+ES_MAXSIZE = int(os.environ.get('RSP_ES_MAXSIZE', 25))
+
+# How long to wait for Elasticsearch when connecting, in seconds
+ES_CONNECT_TIMEOUT = float(os.environ.get('RSP_ES_CONNECT_TIMEOUT', 60))
+
+# Timeout of Elasticsearch requests, in seconds
+ES_TIMEOUT = float(os.environ.get('RSP_ES_TIMEOUT', 10))
+
+# Timeout of app requests, in seconds
+REQUEST_TIMEOUT = float(os.environ.get('RSP_REQUEST_TIMEOUT', 5))
@@ -0,0 +1,319 @@
+"""
+Compact corpus store, replacing one JSON file per document.
+
+Documents of each source are appended to segments:
+    <root>/<source>/<seq>.jsonl.gz
+Each segment is a sequence of gzip members, each holding a batch of JSON
+lines, so it can also be read with any gzip reader. A sidecar index
+    <root>/<source>/<seq>.idx
+maps each document key (see `util.doc_id`) to the offset and length of its
+member, its line in the member and its size. When a document is saved again, the
+latest version supersedes the previous ones, until they are dropped by
+`compact`.
+
+Set `RSP_CORPUS_FORMAT=segments` to make crawlers write segments instead of
+JSON files (see `save_doc`). Either way, saved documents are recorded in the
+seen index of the corpus (see `seen_index`).
+"""
+
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+import os
+import re
+import gzip
+import json
+import atexit
+import threading
+from pathlib import Path
+from roam_sanity.util import (doc_id, json_loads, save_as_json,
+                              get_by_extension, decode_file, LoadedFile)
+from roam_sanity.seen import SeenIndex
+
+
+SEGMENT_SUFFIX = '.jsonl.gz'
+INDEX_SUFFIX = '.idx'
+SEEN_DIRNAME = '.rsp_seen'
+KEY_RE = re.compile(r'^[0-9a-f]{56}$')
+
+
+class Location(NamedTuple):
+    """Where the latest version of a document is stored"""
+    segment: Path
+    offset: int
+    length: int
+    line: int
+    size: int
+
+
+class SegmentChunk(NamedTuple):
+    """Documents to read from a segment, for loading in worker processes.
+    `records` are `Location`s with their key, in file order."""
+    segment: Path
+    source: str
+    records: List[Tuple[str, Location]]
+
+
+def _seq(path: Path) -> int:
+    return int(path.name[:-len(SEGMENT_SUFFIX)])
+
+
+def _index_path(segment: Path) -> Path:
+    return segment.with_name(segment.name[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX)
+
+
+def _read_member(f, offset: int, length: int) -> List[bytes]:
+    f.seek(offset)
+    return gzip.decompress(f.read(length)).split(b'\n')
+
+
+class SegmentWriter:
+    """Appends documents of a source to new segments.
+    Documents are buffered and written `batch_size` at a time, as one gzip
+    member. Thread-safe."""
+    def __init__(self, dir_path: Path, batch_size: int = 64,
+                 segment_max_bytes: int = 64 * 2**20):
+        self.dir_path = dir_path
+        self.batch_size = batch_size
+        self.segment_max_bytes = segment_max_bytes
+        self.dir_path.mkdir(parents=True, exist_ok=True)
+
+        self._buffer = []  # type: List[Tuple[str, bytes]]
+        self._segment = None  # type: Optional[Path]
+        self._lock = threading.Lock()
+
+    def _claim_segment(self) -> Path:
+        """Creates a new segment, safely with concurrent writers"""
+        existing = [_seq(p) for p in self.dir_path.glob(f'*{SEGMENT_SUFFIX}')]
+        seq = max(existing, default=-1) + 1
+        while True:
+            path = self.dir_path / f'{seq:06d}{SEGMENT_SUFFIX}'
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return path
+            except FileExistsError:
+                seq += 1
+
+    def append(self, doc: Dict):
+        line = json.dumps(doc, sort_keys=True, ensure_ascii=False)
+        with self._lock:
+            self._buffer.append((doc_id(doc), line.encode('utf-8')))
+            if len(self._buffer) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        if self._segment is None \
+                or self._segment.stat().st_size >= self.segment_max_bytes:
+            self._segment = self._claim_segment()
+
+        member = gzip.compress(b''.join(line + b'\n'
+                                        for _, line in self._buffer))
+        with open(self._segment, 'ab') as f:
+            offset = f.tell()
+            f.write(member)
+        with open(_index_path(self._segment), 'a') as f:
+            for i, (key, line) in enumerate(self._buffer):
+                f.write(f'{key}\t{offset}\t{len(member)}\t{i}\t'
+                        f'{len(line)}\n')
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+
+
+class SegmentStore:
+    """Segments of all sources, under `root`"""
+    def __init__(self, root: Path):
+        self.root = root
+        self._writers = {}  # type: Dict[str, SegmentWriter]
+        self._lock = threading.Lock()
+        # Locations by source, with the sizes of the indexes they were read from
+        self._locations = {}  # type: Dict[str, Tuple[List, Dict[str, Location]]]
+
+    def sources(self) -> List[str]:
+        if not self.root.is_dir():
+            return []
+        return sorted(p.name for p in self.root.iterdir()
+                      if p.is_dir() and self.segments(p.name))
+
+    def segments(self, source: str) -> List[Path]:
+        """Returns segments of a source, from the oldest to the newest"""
+        return sorted((self.root / source).glob(f'*{SEGMENT_SUFFIX}'),
+                      key=_seq)
+
+    def locations(self, source: str) -> Dict[str, Location]:
+        """Returns where the latest version of each document is stored.
+        Indexes are only read again when they have changed."""
+        state = []
+        for segment in self.segments(source):
+            try:
+                state.append((segment.name,
+                              _index_path(segment).stat().st_size))
+            except FileNotFoundError:
+                pass
+        cached = self._locations.get(source)
+        if cached is not None and cached[0] == state:
+            return cached[1]
+
+        res = {}  # type: Dict[str, Location]
+        for segment in self.segments(source):
+            index_path = _index_path(segment)
+            if not index_path.is_file():
+                continue
+            with open(index_path, 'r') as f:
+                for entry in f:
+                    key, *values = entry.rstrip('\n').split('\t')
+                    res[key] = Location(segment, *map(int, values))
+        self._locations[source] = (state, res)
+        return res
+
+    def writer(self, source: str) -> SegmentWriter:
+        with self._lock:
+            if source not in self._writers:
+                self._writers[source] = SegmentWriter(self.root / source)
+            return self._writers[source]
+
+    def append(self, doc: Dict):
+        self.writer(doc['source']).append(doc)
+
+    def flush(self):
+        for writer in list(self._writers.values()):
+            writer.flush()
+
+    def get(self, source: str, key: str) -> Optional[Dict]:
+        """Reads a single document, from its key.
+        Loads the index of the source, use `iter_docs` for bulk reads."""
+        location = self.locations(source).get(key)
+        if location is None:
+            return None
+        with open(location.segment, 'rb') as f:
+            lines = _read_member(f, location.offset, location.length)
+        return json_loads(lines[location.line])
+
+    def iter_chunks(self, chunk_size: int = 256,
+                    source: Optional[str] = None) -> Iterator[SegmentChunk]:
+        """Splits the latest versions of documents into chunks, in file
+        order, so segments are read sequentially"""
+        for source_ in [source] if source else self.sources():
+            by_segment = {}  # type: Dict[Path, List[Tuple[str, Location]]]
+            for key, loc in self.locations(source_).items():
+                by_segment.setdefault(loc.segment, []).append((key, loc))
+            for segment in self.segments(source_):
+                records = sorted(by_segment.get(segment, []),
+                                 key=lambda r: (r[1].offset, r[1].line))
+                for i in range(0, len(records), chunk_size):
+                    yield SegmentChunk(segment, source_,
+                                       records[i:i + chunk_size])
+
+    def iter_docs(self) -> Iterator[Dict]:
+        """Streams the latest versions of all documents"""
+        for chunk in self.iter_chunks():
+            for loaded in load_segment_chunk(chunk):
+                if loaded.doc is not None:
+                    yield loaded.doc
+
+    def compact(self, source: str):
+        """Rewrites the segments of a source without superseded versions.
+        Must not run while the source is being crawled."""
+        old_segments = self.segments(source)
+        if not old_segments:
+            return
+
+        writer = SegmentWriter(self.root / source, batch_size=256)
+        for chunk in self.iter_chunks(source=source):
+            for loaded in load_segment_chunk(chunk):
+                if loaded.doc is not None:
+                    writer.append(loaded.doc)
+        writer.close()
+
+        for segment in old_segments:
+            _index_path(segment).unlink()
+            segment.unlink()
+
+
+def load_segment_chunk(chunk: SegmentChunk,
+                       transform: Optional[Callable[[Dict], Dict]] = None
+                       ) -> List[LoadedFile]:
+    """Reads, decodes and optionally transforms the documents of a chunk, so
+    it can run in a worker process.
+    Documents are reported under the path they would have as JSON files
+    (with the mtime of their segment), so build manifests work the same with
+    both layouts."""
+    res = []  # type: List[LoadedFile]
+    mtime = chunk.segment.stat().st_mtime
+    members = {}  # type: Dict[int, List[bytes]]
+    with open(chunk.segment, 'rb') as f:
+        for key, loc in chunk.records:
+            path = chunk.segment.parent / f'{key}.json'
+            try:
+                if loc.offset not in members:
+                    members = {loc.offset: _read_member(f, loc.offset,
+                                                        loc.length)}
+                content = members[loc.offset][loc.line]
+            except (OSError, EOFError, IndexError) as e:
+                res.append(LoadedFile(path, 0, 0., '', None, repr(e)))
+                continue
+
+            res.append(decode_file(path, len(content), mtime, content,
+                                   transform))
+    return res
+
+
+def iter_keys(data_path: Path) -> Iterator[str]:
+    """Yields the keys of documents in both layouts, without reading them"""
+    for path in get_by_extension(data_path, 'json'):
+        key = path.name[:-len('.json')]
+        if not KEY_RE.match(key):
+            # Not saved by `save_as_json`
+            try:
+                with open(path, 'rb') as f:
+                    key = doc_id(json_loads(f.read()))
+            except (OSError, KeyError, TypeError, ValueError):
+                continue
+        yield key
+    store = SegmentStore(data_path)
+    for source in store.sources():
+        yield from store.locations(source)
+
+
+_store = None  # type: Optional[SegmentStore]
+_seen_index = None  # type: Optional[SeenIndex]
+
+
+def seen_index() -> SeenIndex:
+    """Returns the seen index of the corpus at `RSP_DATA_PATH`, built from
+    the corpus the first time"""
+    global _seen_index  # pylint: disable=global-statement
+    if _seen_index is None:
+        data_path = Path(os.environ['RSP_DATA_PATH'])
+        _seen_index = SeenIndex(data_path / SEEN_DIRNAME)
+        if not _seen_index.keys_path.is_file():
+            _seen_index.add_keys(iter_keys(data_path))
+            _seen_index.merge()
+        atexit.register(_seen_index.close)
+    return _seen_index
+
+
+def save_doc(doc: Dict):
+    """Saves a crawled document, in the format set by `RSP_CORPUS_FORMAT`
+    (`json`, the default, or `segments`)"""
+    global _store  # pylint: disable=global-statement
+    if os.environ.get('RSP_CORPUS_FORMAT', 'json') != 'segments':
+        save_as_json(doc)
+    else:
+        if _store is None:
+            _store = SegmentStore(Path(os.environ['RSP_DATA_PATH']))
+            atexit.register(_store.flush)
+        _store.append(doc)
+    seen_index().add_key(doc_id(doc))
+
+
+def flush_docs():
+    """Writes the documents buffered by `save_doc`, which is otherwise done at
+    exit. Needed in worker processes, which don't run exit handlers."""
+    if _store is not None:
+        _store.flush()
@@ -1,12 +1,28 @@
-from typing import Dict, List, Tuple
-import json
+from typing import Dict, List, Tuple, Iterator, Optional, Set, Any
+import copy
 import time
+import random
+import threading
+from datetime import datetime
 from pathlib import Path
 from tqdm import tqdm
 from loguru import logger
 from cached_property import cached_property
 import elasticsearch
-from roam_sanity.util import get_by_extension
+from elasticsearch.helpers import parallel_bulk
+from roam_sanity import config
+from roam_sanity.util import get_by_extension, doc_id
+from roam_sanity.manifest import BuildManifest
+from roam_sanity.corpus import SegmentStore, SegmentChunk
+from roam_sanity.queries import (Hits, SearchFilters, SORT_RELEVANCE,
+                                 SORT_BOOSTED, COLLAPSE_FIELD,
+                                 MAPPING_CHECK_INTERVAL, BUILD_META_FIELD,
+                                 build_search_body, parse_search_response,
+                                 build_facets_body, parse_facets_response,
+                                 recency_origin, supports_collapse,
+                                 parse_build_id)
+from roam_sanity.interface import SearchBackend, BulkReport
+from roam_sanity.loading import load_in_parallel, prepare_doc
 
 
 # Settings for Elasticsearch
@@ -40,100 +56,493 @@ ANALYZER_SETTINGS = {
                 'search_analyzer': 'tags_analyzer',
                 'index': True
             },
+            # Exact values, for filters, lookups and aggregations
             'url': {
-                'type': 'text',
-                'analyzer': 'whitespace',
-                'search_analyzer': 'whitespace',
-                'index': True
+                'type': 'keyword'
             },
             'source': {
+                'type': 'keyword'
+            },
+            'channel': {
+                'type': 'keyword'
+            },
+            'database': {
+                'type': 'keyword'
+            },
+            'author_screen_name': {
+                'type': 'keyword'
+            },
+            'doc_id': {
+                'type': 'keyword'
+            },
+            # Blocks are collapsed by page
+            'page_url': {
+                'type': 'keyword'
+            },
+            'page_uid': {
+                'type': 'keyword'
+            },
+            'uid': {
+                'type': 'keyword'
+            },
+            'breadcrumb': {
                 'type': 'text',
-                'analyzer': 'whitespace',
-                'search_analyzer': 'whitespace',
-                'index': True
+                'index': False
+            },
+            # Some crawled dates are empty
+            'create_time': {
+                'type': 'date',
+                'ignore_malformed': True
+            },
+            'edit_time': {
+                'type': 'date',
+                'ignore_malformed': True
+            },
+            'parsing_time': {
+                'type': 'date',
+                'ignore_malformed': True
+            },
+            # Display fields, see `roam_sanity.transforms`
+            'display_title': {
+                'type': 'text',
+                'index': False
+            },
+            'snippet': {
+                'type': 'text',
+                'index': False
+            },
+            'display_date': {
+                'type': 'keyword',
+                'index': False
+            },
+            'timestamp': {
+                'type': 'double'
+            },
+            'messages': {
+                'type': 'text',
+                'index': False
+            },
+            'has_more': {
+                'type': 'boolean',
+                'index': False
+            },
+            'display_breadcrumb': {
+                'type': 'text',
+                'index': False
             },
         }
     }
 }
 
 
-class _Index:
+# Build manifest location, relative to the data folder
+MANIFEST_FILENAME = '.rsp_manifest'
+
+# Settings of a new index version, while it is being bulk loaded
+BULK_LOAD_SETTINGS = {
+    'refresh_interval': '-1',
+    'number_of_replicas': 0,
+}  # type: Dict[str, Any]
+
+# Segments are sorted by recency, so searches sorted by recency can stop
+# early. Static settings, applied when an index version is created.
+INDEX_SORT_SETTINGS = {
+    'sort.field': ['timestamp', 'doc_id'],
+    'sort.order': ['desc', 'asc'],
+    'sort.missing': ['_last', '_last'],
+}
+
+# Settings applied to an index version before it goes live
+PRODUCTION_SETTINGS = {
+    'refresh_interval': '1s',
+    'number_of_replicas': 1,
+}  # type: Dict[str, Any]
+
+
+class _Index(SearchBackend):
+    """Elasticsearch index read and written through the alias `name`.
+    Full builds load a new version `<name>_<timestamp>`, which replaces the
+    previous one atomically once it is ready."""
     def __init__(self, name: str):
         self.name = name
-        if not self.es_client.indices.exists(index=self.name):
-            self.es_client.indices.create(self.name, body=ANALYZER_SETTINGS)
+        # Result of the last check of Elasticsearch, replaced as a whole
+        self._status = {'ready': False, 'error': None}  # type: Dict[str, Any]
+        self._connected = False
+        self._has_index = False
+        # Time of the last check of the mapping, and whether it allows
+        # collapsing hits
+        self._collapse = (None, False)  # type: Tuple[Optional[float], bool]
+        self._checker = None  # type: Optional[threading.Thread]
+        self._checker_lock = threading.Lock()
 
     @cached_property
-    def es_client(self):  # pylint: disable=no-self-use
-        es = elasticsearch.Elasticsearch()
+    def _client(self) -> elasticsearch.Elasticsearch:
+        return elasticsearch.Elasticsearch(config.ES_HOSTS,
+                                           maxsize=config.ES_MAXSIZE,
+                                           timeout=config.ES_TIMEOUT)
 
+    @property
+    def es_client(self) -> elasticsearch.Elasticsearch:
+        """Connects on first use"""
+        if not self._connected:
+            self._wait_until_ready()
+            self._connected = True
+        return self._client
+
+    def _wait_until_ready(self):
+        """Waits for Elasticsearch with an exponential backoff, for at most
+        `config.ES_CONNECT_TIMEOUT` seconds.
+        Raises ConnectionError if Elasticsearch isn't available by then."""
         logger.info('Waiting for Elasticsearch')
-        while True:
+        deadline = time.time() + config.ES_CONNECT_TIMEOUT
+        delay = 0.5
+        while not self._check():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise ConnectionError("Can't connect to Elasticsearch: "
+                                      f"{self._status['error']}")
+            # Jitter avoids synchronized retries from many workers
+            time.sleep(min(delay * random.uniform(0.5, 1.5), remaining))
+            delay = min(delay * 2, 30)
+
+    def _check(self) -> bool:
+        try:
+            self._client.info()
+        except (elasticsearch.exceptions.ConnectionError,
+                elasticsearch.exceptions.TransportError) as e:
+            self._status = {'ready': False, 'error': repr(e)}
+            return False
+        self._status = {'ready': True, 'error': None}
+        return True
+
+    def health(self) -> Dict[str, Any]:
+        """Returns the result of the last check, and checks Elasticsearch
+        again in the background, so it doesn't wait on the network"""
+        with self._checker_lock:
+            if self._checker is None or not self._checker.is_alive():
+                self._checker = threading.Thread(target=self._check,
+                                                 daemon=True)
+                self._checker.start()
+        return dict(self._status, backend='elasticsearch')
+
+    def ensure_index(self):
+        """Creates an empty index if there is none. Only writes create it:
+        reads find no documents until then."""
+        if self._has_index:
+            return
+        if not self.es_client.indices.exists(index=self.name):
+            version = self._create_version(PRODUCTION_SETTINGS)
+            self._switch_alias(version)
+        self._has_index = True
+
+    def populate(self, data_path: Path, chunk_size: int = 500,
+                 n_workers: int = 4, n_loaders: Optional[int] = None,
+                 incremental: bool = False,
+                 manifest_path: Optional[Path] = None,
+                 n_replicas: int = PRODUCTION_SETTINGS['number_of_replicas'],
+                 retention: int = 2, **kwargs) -> BulkReport:
+        """Loads JSON files and corpus segments from disk and bulk loads them
+        into Elasticsearch. Files are discovered and decoded by `n_loaders`
+        processes (one per core by default) while being indexed.
+
+        A full build loads a new index version, tunes it for production and
+        then switches the alias to it, so searches never see a partial index.
+        Only the `retention` latest versions are kept.
+
+        In incremental mode, only new or changed files (according to the
+        build manifest) are upserted into the live version, and documents
+        whose file has disappeared are deleted."""
+        manifest = BuildManifest.load(manifest_path or
+                                      data_path / MANIFEST_FILENAME)
+        if incremental:
+            self.ensure_index()
+            target = self.current_version() or self.name
+            self._update_mapping(target)
+        else:
+            target = self._create_version(BULK_LOAD_SETTINGS)
+            manifest.clear()
+        logger.info(f'Loading documents into `{target}`')
+
+        report = BulkReport()
+        failed_ids = set()  # type: Set[str]
+        paths = get_by_extension(data_path, 'json')
+        chunks = SegmentStore(data_path).iter_chunks()
+        actions = self._iter_actions(target, data_path, paths, chunks,
+                                     manifest, report, incremental, n_loaders)
+
+        results = parallel_bulk(self.es_client, actions,
+                                chunk_size=chunk_size,
+                                thread_count=n_workers,
+                                raise_on_error=False,
+                                raise_on_exception=False)
+        for ok, item in tqdm(results, unit='doc'):
+            op_type, info = next(iter(item.items()))
+            if op_type == 'delete':
+                # Deleting a document that is already gone is fine
+                if ok or info.get('status') == 404:
+                    report.n_deleted += 1
+                    continue
+            elif ok:
+                report.n_indexed += 1
+                continue
+            failed_ids.add(info.get('_id'))
+            report.add_failure(info.get('_id'), info.get('error'))
+
+        if incremental:
+            self.es_client.indices.refresh(index=target)
+        else:
+            self._finalize_version(target, n_replicas)
+            self._switch_alias(target)
+            self._delete_old_versions(retention)
+        self._stamp_build(target)
+
+        # Failed documents will be retried by the next incremental build
+        for key in manifest.keys():
+            entry = manifest.get(key)
+            if entry and entry['id'] in failed_ids:
+                manifest.remove(key)
+        manifest.save()
+
+        report.end_time = time.time()
+        return report
+
+    def _iter_actions(self, target: str, data_path: Path,
+                      paths: Iterator[Path], chunks: Iterator[SegmentChunk],
+                      manifest: BuildManifest, report: BulkReport,
+                      incremental: bool,
+                      n_loaders: Optional[int] = None) -> Iterator[Dict]:
+        seen = set()  # type: Set[str]
+
+        def _to_load() -> Iterator[Path]:
+            for path in paths:
+                key = str(path.relative_to(data_path))
+                seen.add(key)
+                if incremental:
+                    stat = path.stat()
+                    if manifest.is_unchanged(key, stat.st_size,
+                                             stat.st_mtime):
+                        report.n_skipped += 1
+                        continue
+                yield path
+
+        def _chunks_to_load() -> Iterator[SegmentChunk]:
+            for chunk in chunks:
+                mtime = chunk.segment.stat().st_mtime
+                records = []
+                for key, loc in chunk.records:
+                    path_key = str((chunk.segment.parent / f'{key}.json')
+                                   .relative_to(data_path))
+                    seen.add(path_key)
+                    if incremental and manifest.is_unchanged(path_key,
+                                                             loc.size, mtime):
+                        report.n_skipped += 1
+                        continue
+                    records.append((key, loc))
+                if records:
+                    yield chunk._replace(records=records)
+
+        for loaded in load_in_parallel(_to_load(), n_loaders,
+                                       chunks=_chunks_to_load()):
+            key = str(loaded.path.relative_to(data_path))
+            source = loaded.doc
+            if loaded.error is not None or source is None:
+                report.add_failure(loaded.path,
+                                   loaded.error or 'No document loaded')
+                manifest.remove(key)
+                continue
+
+            id_ = source['doc_id']
+            previous = manifest.get(key)
+            manifest.update(key, loaded.size, loaded.mtime, loaded.digest, id_)
+            if previous and previous['hash'] == loaded.digest \
+                    and previous['id'] == id_:
+                # Touched, but not modified
+                report.n_skipped += 1
+                continue
+            yield {
+                '_op_type': 'index',
+                '_index': target,
+                '_id': id_,
+                '_source': source,
+            }
+
+        # Files that have disappeared since the last build
+        gone = [key for key in manifest.keys() if key not in seen]
+        gone_ids = {manifest.remove(key)['id'] for key in gone}  # type: ignore
+        live_ids = {e['id'] for e in manifest.entries.values()}
+        for id_ in gone_ids - live_ids:
+            yield {
+                '_op_type': 'delete',
+                '_index': target,
+                '_id': id_,
+            }
+
+    def versions(self) -> List[str]:
+        """Returns index versions, from the oldest to the newest"""
+        res = self.es_client.indices.get(index=f'{self.name}_*',  # pylint: disable=unexpected-keyword-arg
+                                         ignore_unavailable=True)
+        return sorted(res)
+
+    def current_version(self) -> Optional[str]:
+        """Returns the index version the alias points to"""
+        if not self.es_client.indices.exists_alias(name=self.name):
+            return None
+        return next(iter(self.es_client.indices.get_alias(name=self.name)))
+
+    def build_id(self) -> Optional[str]:
+        """Returns the index version the alias points to, with the time of
+        its last build"""
+        try:
+            res = self.es_client.indices.get_mapping(index=self.name)
+        except elasticsearch.exceptions.NotFoundError:
+            return None
+        return parse_build_id(res)
+
+    def _create_version(self, settings: Dict) -> str:
+        version = f"{self.name}_{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}"
+        body = copy.deepcopy(ANALYZER_SETTINGS)
+        body['settings']['index'] = dict(INDEX_SORT_SETTINGS, **settings)
+        self.es_client.indices.create(index=version, body=body)
+        return version
+
+    def _update_mapping(self, version: str):
+        """Adds the fields of the current mapping to an index version, so
+        incremental builds don't map them dynamically.
+        Raises ValueError if the version maps some fields differently."""
+        try:
+            self.es_client.indices.put_mapping(
+                index=version, body=ANALYZER_SETTINGS['mappings'])
+        except elasticsearch.exceptions.RequestError as e:
+            raise ValueError(f'`{version}` was built with an older mapping, '
+                             f'run a full build: {e.info}') from e
+
+    def _stamp_build(self, version: str):
+        """Records the time of the build in the mapping of `version`, so
+        `build_id` changes after incremental builds too"""
+        built_at = datetime.utcnow().isoformat()
+        self.es_client.indices.put_mapping(
+            index=version, body={'_meta': {BUILD_META_FIELD: built_at}})
+
+    def _supports_collapse(self) -> bool:
+        """Whether hits of the live version can be collapsed (see
+        `queries.supports_collapse`), checked every `MAPPING_CHECK_INTERVAL`
+        seconds"""
+        now = time.time()
+        checked_at, collapse = self._collapse
+        if checked_at is None or now - checked_at >= MAPPING_CHECK_INTERVAL:
             try:
-                es.search(index='')
-                break
-            except (elasticsearch.exceptions.ConnectionError,
-                    elasticsearch.exceptions.TransportError):
-                time.sleep(1)
-
-        return es
-
-    def populate(self, data_path: Path):
-        """Loads JSON files from disk and populates Elasticsearch"""
-        self.empty()
-
-        paths = list(get_by_extension(data_path, 'json'))
-        for path in tqdm(paths):
-            with open(path, 'r') as f:
-                obj = json.load(f)
-                try:
-                    self.add(obj)
-                except:
-                    print(obj)
+                res = self.es_client.indices.get_field_mapping(
+                    fields=COLLAPSE_FIELD, index=self.name)
+            except elasticsearch.exceptions.NotFoundError:
+                res = {}
+            collapse = supports_collapse(res)
+            self._collapse = (now, collapse)
+        return collapse
+
+    def _finalize_version(self, version: str, n_replicas: int):
+        """Makes an index version ready for production"""
+        logger.info(f'Optimizing `{version}`')
+        settings = dict(PRODUCTION_SETTINGS, number_of_replicas=n_replicas)
+        self.es_client.indices.put_settings(index=version,
+                                            body={'index': settings})
+        self.es_client.indices.refresh(index=version)
+        self.es_client.indices.forcemerge(index=version, max_num_segments=1,  # pylint: disable=unexpected-keyword-arg
+                                          request_timeout=3600)
+
+    def _switch_alias(self, version: str):
+        """Points the alias to `version`, atomically"""
+        actions = []  # type: List[Dict]
+        if self.es_client.indices.exists_alias(name=self.name):
+            actions.append({'remove': {'index': '*', 'alias': self.name}})
+        elif self.es_client.indices.exists(index=self.name):
+            # Unversioned index from an older build
+            actions.append({'remove_index': {'index': self.name}})
+        actions.append({'add': {'index': version, 'alias': self.name}})
+
+        self.es_client.indices.update_aliases(body={'actions': actions})
+        logger.info(f'`{self.name}` now points to `{version}`')
+
+    def _delete_old_versions(self, retention: int):
+        """Deletes all but the `retention` latest versions.
+        The live version is never deleted."""
+        current = self.current_version()
+        old = [v for v in self.versions() if v != current]
+        for version in old[:max(0, len(old) - max(0, retention - 1))]:
+            logger.info(f'Deleting `{version}`')
+            self.es_client.indices.delete(index=version)
 
     def add(self, doc: Dict):
-        self.es_client.index(index=self.name, body=doc)
+        self.ensure_index()
+        source = prepare_doc(doc)
+        self.es_client.index(index=self.name, id=source['doc_id'], body=source)
 
     def get(self, **kwargs) -> List[Dict]:
-        res = self.es_client.search(
-            index=self.name,
-            body={
-                'query': {
-                    'bool': {
-                        'must': [
-                            {'term': {k: v}}
-                            for k, v in kwargs.items()
-                        ]
+        try:
+            res = self.es_client.search(
+                index=self.name,
+                body={
+                    'query': {
+                        'bool': {
+                            'filter': [
+                                {'term': {k: v}}
+                                for k, v in kwargs.items()
+                            ]
+                        }
                     }
                 }
-            }
-        )
+            )
+        except elasticsearch.exceptions.NotFoundError:
+            # No index yet
+            return []
         return [e['_source'] for e in res['hits']['hits']]
 
+    def get_by_id(self, id_: str,
+                  fields: Optional[List[str]] = None) -> Optional[Dict]:
+        kwargs = {} if fields is None \
+            else {'_source_includes': fields}  # type: Dict[str, Any]
+        try:
+            return self.es_client.get(index=self.name, id=id_,
+                                      **kwargs)['_source']
+        except elasticsearch.exceptions.NotFoundError:
+            return None
+
     def contains(self, doc: Dict) -> bool:
-        return bool(self.get(url=doc['url']))
-
-    def search(self, query: str, k: int) -> List[Tuple[float, Dict]]:
-        res = self.es_client.search(
-            index=self.name,
-            body={
-                'query': {
-                    'match' : {
-                        'text': {
-                            'query': query,
-                            'fuzziness': 0
-                        }
-                    }
-                },
-                'size': k
-            }
-        )
+        # Documents are stored under their id, so this is a realtime lookup
+        # instead of a search on the analyzed `url` field
+        return self.es_client.exists(index=self.name, id=doc_id(doc))
+
+    def search_page(self, query: str, k: int, cursor: Optional[str] = None,
+                    fields: Optional[List[str]] = None,
+                    filters: Optional[SearchFilters] = None,
+                    sort: str = SORT_RELEVANCE) -> Tuple[Hits, Optional[str]]:
+        origin = recency_origin(cursor) if sort == SORT_BOOSTED else None
+        body = build_search_body(query, k, cursor, fields, filters, sort,
+                                 origin, self._supports_collapse())
+        try:
+            res = self.es_client.search(index=self.name, body=body)
+        except elasticsearch.exceptions.NotFoundError:
+            # No index yet
+            return [], None
+        return parse_search_response(res, k, origin, body.get('from'))
 
-        return [(e['_score'], e['_source']) for e in res['hits']['hits']]
+    def facets(self, query: str,
+               filters: Optional[SearchFilters] = None) -> Dict[str, int]:
+        try:
+            res = self.es_client.search(
+                index=self.name,
+                body=build_facets_body(query, filters,
+                                       self._supports_collapse()))
+        except elasticsearch.exceptions.NotFoundError:
+            # No index yet
+            return {}
+        return parse_facets_response(res)
 
     def empty(self):
-        self.es_client.indices.delete(index=self.name, ignore=[400, 404])  # pylint: disable=unexpected-keyword-arg
-        self.__init__(self.name)
+        """Replaces the live index by an empty version"""
+        version = self._create_version(PRODUCTION_SETTINGS)
+        self._switch_alias(version)
+        self._delete_old_versions(retention=1)
 
 
-index = _Index('rsp')
+# Doesn't connect until it is used
+index = _Index(config.INDEX_NAME)
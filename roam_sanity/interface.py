@@ -0,0 +1,97 @@
+"""Interface of search backends"""
+
+from typing import Any, Dict, List, Optional, Tuple
+import time
+from pathlib import Path
+from roam_sanity.queries import Hits, SearchFilters, SORT_RELEVANCE
+
+
+class BulkReport:
+    """Outcome of a bulk load: counts, timing and per-document failures"""
+    def __init__(self):
+        self.n_indexed = 0
+        self.n_deleted = 0
+        self.n_skipped = 0
+        self.failures = []  # type: List[Dict[str, Any]]
+        self.start_time = time.time()
+        self.end_time = None  # type: Optional[float]
+
+    @property
+    def n_failed(self) -> int:
+        return len(self.failures)
+
+    @property
+    def elapsed(self) -> float:
+        end_time = self.end_time if self.end_time is not None else time.time()
+        return end_time - self.start_time
+
+    @property
+    def docs_per_sec(self) -> float:
+        return self.n_indexed / self.elapsed if self.elapsed > 0 else 0.
+
+    def add_failure(self, ref: Any, error: Any):
+        """`ref` identifies the document: a file path or a document id"""
+        self.failures.append({'ref': str(ref), 'error': error})
+
+
+class SearchBackend:
+    """Operations the app and the build script rely on"""
+    def populate(self, data_path: Path, **kwargs) -> BulkReport:
+        """(Re)builds the index from JSON files.
+        Backends ignore the options they don't support."""
+        raise NotImplementedError
+
+    def add(self, doc: Dict):
+        raise NotImplementedError
+
+    def get(self, **kwargs) -> List[Dict]:
+        """Returns documents whose fields match `kwargs` exactly"""
+        raise NotImplementedError
+
+    def get_by_id(self, id_: str,
+                  fields: Optional[List[str]] = None) -> Optional[Dict]:
+        """Returns a document (only `fields` if specified), or None"""
+        raise NotImplementedError
+
+    def contains(self, doc: Dict) -> bool:
+        raise NotImplementedError
+
+    def search(self, query: str, k: int,
+               filters: Optional[SearchFilters] = None) -> Hits:
+        return self.search_page(query, k, filters=filters)[0]
+
+    def search_page(self, query: str, k: int, cursor: Optional[str] = None,
+                    fields: Optional[List[str]] = None,
+                    filters: Optional[SearchFilters] = None,
+                    sort: str = SORT_RELEVANCE) -> Tuple[Hits, Optional[str]]:
+        """Returns `k` hits following `cursor`, and the cursor of the next
+        page (None if there are no more hits).
+        Only `fields` are returned if specified, and only documents matching
+        `filters`, which don't affect scores.
+        Hits are ordered according to `sort` (see `queries.SORT_MODES`), and
+        then by id. Unless they are sorted by recency, they are collapsed by
+        `page_url`: only the best hit of a page is returned, with its best
+        hits as `blocks` if there are several (see `queries.N_BLOCKS_MAX`).
+        Raises ValueError if the sort mode or the cursor is invalid."""
+        raise NotImplementedError
+
+    def facets(self, query: str,
+               filters: Optional[SearchFilters] = None) -> Dict[str, int]:
+        """Returns the number of matching pages per source, ignoring the
+        source filter"""
+        raise NotImplementedError
+
+    def current_version(self) -> Optional[str]:
+        """Identifies the content of the index, changes after a rebuild"""
+        raise NotImplementedError
+
+    def build_id(self) -> Optional[str]:
+        """Changes after every build, incremental ones included"""
+        return self.current_version()
+
+    def health(self) -> Dict[str, Any]:
+        """Readiness of the backend, for health checks. Must not block."""
+        raise NotImplementedError
+
+    def empty(self):
+        raise NotImplementedError
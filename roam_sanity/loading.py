@@ -0,0 +1,55 @@
+"""Reading and preparing documents before they are indexed"""
+
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+import os
+from itertools import chain
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from roam_sanity.util import iter_batches, load_json_files, doc_id, LoadedFile
+from roam_sanity.transforms import enrich
+from roam_sanity.corpus import SegmentChunk, load_segment_chunk
+
+
+def prepare_doc(doc: Dict) -> Dict:
+    """Returns the indexed version of a document"""
+    res = enrich(doc)
+    res['doc_id'] = doc_id(doc)
+    return res
+
+
+# Files are loaded in batches, and segments by chunk
+LoadUnit = Union[List[Path], SegmentChunk]
+
+
+def _load(unit: LoadUnit) -> List[LoadedFile]:
+    if isinstance(unit, SegmentChunk):
+        return load_segment_chunk(unit, transform=prepare_doc)
+    return load_json_files(unit, transform=prepare_doc)
+
+
+def load_in_parallel(paths: Iterator[Path], n_loaders: Optional[int] = None,
+                     batch_size: int = 256,
+                     chunks: Iterable[SegmentChunk] = ()
+                     ) -> Iterator[LoadedFile]:
+    """Decodes and prepares JSON files, then documents of corpus segments, in
+    a pool of processes.
+    Batches of paths are submitted as they are discovered, with a bounded
+    number of batches in flight, and results are yielded in submission order."""
+    n_loaders = n_loaders or os.cpu_count() or 1
+    batches = chain(iter_batches(paths, batch_size),
+                    chunks)  # type: Iterator[LoadUnit]
+
+    if n_loaders <= 1:
+        for batch in batches:
+            yield from _load(batch)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_loaders) as executor:
+        pending = deque()  # type: deque
+        for batch in batches:
+            pending.append(executor.submit(_load, batch))
+            if len(pending) >= 2 * n_loaders:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
@@ -0,0 +1,54 @@
+from typing import Dict, Iterator, Optional
+import os
+import json
+from pathlib import Path
+
+
+class BuildManifest:
+    """Records the files that were indexed by the last build.
+    Maps each file path (relative to the data folder) to its size, mtime,
+    content hash and document id."""
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries = {}  # type: Dict[str, Dict]
+
+    @classmethod
+    def load(cls, path: Path) -> 'BuildManifest':
+        manifest = cls(path)
+        if path.is_file():
+            with open(path, 'r') as f:
+                manifest.entries = json.load(f)
+        return manifest
+
+    def save(self):
+        """Writes the manifest atomically"""
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key: str) -> Optional[Dict]:
+        return self.entries.get(key)
+
+    def is_unchanged(self, key: str, size: int, mtime: float) -> bool:
+        entry = self.entries.get(key)
+        return (entry is not None and entry['size'] == size
+                and entry['mtime'] == mtime)
+
+    def update(self, key: str, size: int, mtime: float, digest: str,
+               doc_id: str):
+        self.entries[key] = {
+            'size': size,
+            'mtime': mtime,
+            'hash': digest,
+            'id': doc_id,
+        }
+
+    def remove(self, key: str) -> Optional[Dict]:
+        return self.entries.pop(key, None)
+
+    def keys(self) -> Iterator[str]:
+        return iter(list(self.entries))
+
+    def clear(self):
+        self.entries = {}
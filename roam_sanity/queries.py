@@ -0,0 +1,348 @@
+"""Elasticsearch queries, shared by the synchronous and asynchronous clients"""
+
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Tuple
+import json
+import base64
+import binascii
+from datetime import datetime, timedelta, timezone
+import dateutil.parser
+
+
+# (score, document) pairs
+Hits = List[Tuple[float, Dict]]
+
+# Maximum number of sources in facets
+N_FACETS_MAX = 50
+
+# Hits are collapsed by page (see `transforms`), with the best matching
+# blocks of each page. Index versions built before `page_url` was mapped as a
+# keyword can't be collapsed, so their hits aren't.
+COLLAPSE_FIELD = 'page_url'
+N_BLOCKS_MAX = 3
+
+# Seconds between checks of the mapping of the live index version
+MAPPING_CHECK_INTERVAL = 10.
+
+# Field of the mapping's `_meta` recording the time of the last build
+BUILD_META_FIELD = 'built_at'
+
+# Elasticsearch rejects `search_after` with `collapse` (unless sorting by the
+# collapse field), so collapsed results are paged by offset, up to its
+# `index.max_result_window`. Other results are paged with `search_after`.
+MAX_RESULT_WINDOW = 10000
+
+# Orders of results
+SORT_RELEVANCE = 'relevance'
+SORT_RECENT = 'recent'
+SORT_BOOSTED = 'boosted'  # Relevance, with a boost for recent documents
+SORT_MODES = (SORT_RELEVANCE, SORT_RECENT, SORT_BOOSTED)
+
+# With the recency boost, scores are multiplied by `RECENCY_DECAY` for each
+# `RECENCY_SCALE` seconds of age
+RECENCY_SCALE = 90 * 24 * 3600
+RECENCY_DECAY = 0.5
+
+
+def _parse_time(value: str) -> float:
+    """Epoch time of an ISO date or datetime (UTC if not specified)"""
+    try:
+        dtm = dateutil.parser.isoparse(value)
+    except (ValueError, OverflowError) as e:
+        raise ValueError(f'Invalid date: {value}') from e
+    if dtm.tzinfo is None:
+        dtm = dtm.replace(tzinfo=timezone.utc)
+    return dtm.timestamp()
+
+
+class SearchFilters(NamedTuple):
+    """Restricts results to some sources, and to a time range on the
+    `timestamp` of documents (`since` included, `until` excluded)"""
+    sources: Tuple[str, ...] = ()
+    since: Optional[float] = None
+    until: Optional[float] = None
+
+    @classmethod
+    def parse(cls, source: Optional[str] = None, since: Optional[str] = None,
+              until: Optional[str] = None) -> 'SearchFilters':
+        """From request arguments: comma-separated sources, and ISO dates.
+        Raises ValueError if a date is invalid."""
+        return cls(
+            sources=tuple(sorted({s.strip() for s in (source or '').split(',')
+                                  if s.strip()})),
+            since=_parse_time(since) if since else None,
+            until=_parse_time(until) if until else None,
+        )
+
+    def matches(self, doc: Dict) -> bool:
+        if self.sources and doc.get('source') not in self.sources:
+            return False
+        if self.since is None and self.until is None:
+            return True
+        timestamp = doc.get('timestamp')
+        return timestamp is not None \
+            and (self.since is None or timestamp >= self.since) \
+            and (self.until is None or timestamp < self.until)
+
+    def to_clauses(self, with_sources: bool = True) -> List[Dict]:
+        """Clauses for the filter context of a bool query, which doesn't
+        affect scores and is cached by Elasticsearch"""
+        clauses = []  # type: List[Dict]
+        if with_sources and self.sources:
+            clauses.append({'terms': {'source': list(self.sources)}})
+        if self.since is not None or self.until is not None:
+            time_range = {}  # type: Dict[str, float]
+            if self.since is not None:
+                time_range['gte'] = self.since
+            if self.until is not None:
+                time_range['lt'] = self.until
+            clauses.append({'range': {'timestamp': time_range}})
+        return clauses
+
+
+def encode_cursor(sort_values: List) -> str:
+    """Opaque pagination cursor, from the sort values of the last hit"""
+    return base64.urlsafe_b64encode(json.dumps(sort_values).encode('utf-8')) \
+        .decode('ascii')
+
+
+def decode_cursor(cursor: str) -> List:
+    """Raises ValueError if the cursor is invalid"""
+    try:
+        sort_values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, UnicodeError, binascii.Error) as e:
+        raise ValueError(f'Invalid cursor: {cursor}') from e
+    if not isinstance(sort_values, list):
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return sort_values
+
+
+def cursor_offset(cursor: Optional[str] = None) -> int:
+    """Number of results before the page of an offset cursor.
+    Raises ValueError if the cursor is invalid."""
+    if not cursor:
+        return 0
+    sort_values = decode_cursor(cursor)
+    if not sort_values or isinstance(sort_values[0], bool) \
+            or not isinstance(sort_values[0], int) or sort_values[0] < 0:
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return sort_values[0]
+
+
+def cursor_search_after(cursor: str) -> List[Any]:
+    """Sort values of the last hit before the page of a `search_after`
+    cursor: its sort value and its id.
+    Raises ValueError if the cursor is invalid."""
+    sort_values = decode_cursor(cursor)
+    if len(sort_values) < 2 or not isinstance(sort_values[1], str):
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return sort_values[:2]
+
+
+def check_sort(sort: str):
+    """Raises ValueError if `sort` isn't a sort mode"""
+    if sort not in SORT_MODES:
+        raise ValueError(f'Invalid sort: {sort}')
+
+
+class SearchArgs(NamedTuple):
+    """Parameters of a search request"""
+    query: str
+    cursor: Optional[str]
+    sort: str
+    filters: SearchFilters
+
+    @classmethod
+    def parse(cls, args: Mapping[str, str]) -> 'SearchArgs':
+        """From the arguments of a request.
+        Raises ValueError if the sort or a date is invalid."""
+        sort = args.get('sort') or SORT_RELEVANCE
+        check_sort(sort)
+        return cls(
+            query=args.get('query') or '',
+            cursor=args.get('cursor') or None,
+            sort=sort,
+            filters=SearchFilters.parse(args.get('source'), args.get('since'),
+                                        args.get('until')),
+        )
+
+
+def recency_origin(cursor: Optional[str] = None) -> float:
+    """Time from which ages are counted for the recency boost: the end of
+    the current day (UTC), or the origin of the first page, kept in cursors
+    so scores are consistent across pages.
+    Raises ValueError if the cursor is invalid."""
+    if cursor:
+        sort_values = decode_cursor(cursor)
+        if len(sort_values) < 2 \
+                or not isinstance(sort_values[-1], (int, float)):
+            raise ValueError(f'Invalid cursor: {cursor}')
+        return float(sort_values[-1])
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0,
+                                               microsecond=0)
+    return (today + timedelta(days=1)).timestamp()
+
+
+def _build_query(query: str, filters: Optional[SearchFilters] = None,
+                 with_sources: bool = True) -> Dict[str, Any]:
+    match = {
+        'match' : {
+            'text': {
+                'query': query,
+                'fuzziness': 0
+            }
+        }
+    }
+    clauses = filters.to_clauses(with_sources) if filters else []
+    if not clauses:
+        return match
+    return {
+        'bool': {
+            'must': match,
+            'filter': clauses,
+        }
+    }
+
+
+def supports_collapse(field_mapping: Dict) -> bool:
+    """Whether hits can be collapsed, from the response of a
+    `get_field_mapping` request on `COLLAPSE_FIELD`: it must be a keyword in
+    every index version"""
+    return bool(field_mapping) and all(
+        e['mappings'].get(COLLAPSE_FIELD, {}).get('mapping', {})
+        .get(COLLAPSE_FIELD, {}).get('type') == 'keyword'
+        for e in field_mapping.values())
+
+
+def parse_build_id(mapping: Dict) -> Optional[str]:
+    """Identifies the live index version and its last build, from the
+    response of a `get_mapping` request on the alias"""
+    if not mapping:
+        return None
+    version, e = next(iter(mapping.items()))
+    built_at = e['mappings'].get('_meta', {}).get(BUILD_META_FIELD)
+    return f'{version}@{built_at}' if built_at else version
+
+
+def build_search_body(query: str, k: int, cursor: Optional[str] = None,
+                      fields: Optional[List[str]] = None,
+                      filters: Optional[SearchFilters] = None,
+                      sort: str = SORT_RELEVANCE,
+                      origin: Optional[float] = None,
+                      collapse: bool = True) -> Dict[str, Any]:
+    """`origin` is required by the recency boost (see `recency_origin`).
+    Hits are collapsed by page if `collapse` (see `supports_collapse` and
+    `parse_search_response`), unless they are sorted by recency: collapsing
+    would prevent the search from terminating early, as the index is sorted
+    by recency too.
+    Raises ValueError if the sort mode or the cursor is invalid."""
+    check_sort(sort)
+    collapse = collapse and sort != SORT_RECENT
+    query_ = _build_query(query, filters)
+    if sort == SORT_BOOSTED:
+        query_ = {
+            'function_score': {
+                'query': query_,
+                'functions': [{
+                    'exp': {
+                        'timestamp': {
+                            'origin': origin,
+                            'scale': RECENCY_SCALE,
+                            'decay': RECENCY_DECAY,
+                        }
+                    }
+                }],
+                'boost_mode': 'multiply',
+            }
+        }
+
+    if sort == SORT_RECENT:
+        # Matches the index sort, so collection can terminate early
+        sort_ = [
+            {'timestamp': {'order': 'desc', 'missing': '_last'}},
+            {'doc_id': 'asc'},
+        ]
+    else:
+        sort_ = [
+            {'_score': 'desc'},
+            {'doc_id': 'asc'},
+        ]
+
+    # Blocks of a page are ordered like pages
+    inner_hits = {
+        'name': 'blocks',
+        'size': N_BLOCKS_MAX,
+        'sort': sort_,
+    }  # type: Dict[str, Any]
+    body = {
+        'query': query_,
+        'sort': sort_,
+        'size': k,
+        'track_total_hits': False,
+    }  # type: Dict[str, Any]
+    if collapse:
+        body['collapse'] = {
+            'field': COLLAPSE_FIELD,
+            'inner_hits': inner_hits,
+        }
+        body['from'] = cursor_offset(cursor)
+    elif cursor:
+        body['search_after'] = cursor_search_after(cursor)
+    if fields is not None:
+        body['_source'] = fields
+        inner_hits['_source'] = fields
+    return body
+
+
+def build_facets_body(query: str, filters: Optional[SearchFilters] = None,
+                      collapse: bool = True) -> Dict[str, Any]:
+    """Counts matching pages (documents if not `collapse`) per source, in a
+    single aggregation.
+    The source filter is ignored, so other sources can be selected."""
+    sources = {
+        'terms': {'field': 'source', 'size': N_FACETS_MAX},
+    }  # type: Dict[str, Any]
+    if collapse:
+        sources['aggs'] = {
+            'pages': {'cardinality': {'field': COLLAPSE_FIELD}},
+        }
+    return {
+        'query': _build_query(query, filters, with_sources=False),
+        'aggs': {
+            'sources': sources,
+        },
+        'size': 0,
+        'track_total_hits': False,
+    }
+
+
+def parse_facets_response(res: Dict) -> Dict[str, int]:
+    return {e['key']: e['pages']['value'] if 'pages' in e else e['doc_count']
+            for e in res['aggregations']['sources']['buckets']}
+
+
+def parse_search_response(res: Dict, k: int, origin: Optional[float] = None,
+                          offset: Optional[int] = None
+                          ) -> Tuple[Hits, Optional[str]]:
+    """Returns hits and the cursor of the next page: the sort values of the
+    last hit, or the number of hits so far if the page started at `offset`
+    (see `MAX_RESULT_WINDOW`). Hits of pages with several matching blocks
+    have the best ones as `blocks`."""
+    hits = res['hits']['hits']
+    next_cursor = None
+    if len(hits) == k and (offset is None
+                           or offset + 2 * k <= MAX_RESULT_WINDOW):
+        sort_values = hits[-1]['sort'] if offset is None \
+            else [offset + k]  # type: List[Any]
+        if origin is not None:
+            sort_values = sort_values + [origin]
+        next_cursor = encode_cursor(sort_values)
+
+    res_hits = []  # type: Hits
+    for e in hits:
+        doc = e['_source']
+        blocks = e.get('inner_hits', {}).get('blocks', {}) \
+            .get('hits', {}).get('hits', [])
+        if len(blocks) > 1:
+            doc = {**doc, 'blocks': [block['_source'] for block in blocks]}
+        res_hits.append((e['_score'], doc))
+    return res_hits, next_cursor
@@ -0,0 +1,76 @@
+"""HTML rendering of search results, shared by the Flask and ASGI apps"""
+
+from typing import Dict
+
+
+MESSAGE_SEP_HTML = '<div class="message_sep">-----</div>'
+
+# Fields needed to render a result, long contents are loaded on demand
+RESULT_FIELDS = [
+    'doc_id',
+    'url',
+    'page_url',
+    'source',
+    'display_title',
+    'snippet',
+    'display_date',
+    'has_more',
+    'display_breadcrumb',
+]
+
+LONG_CONTENT_FIELDS = ['text', 'messages']
+
+
+def format_long_content(raw: Dict) -> str:
+    if 'messages' in raw:
+        return MESSAGE_SEP_HTML.join(raw['messages'])
+    return raw['text']
+
+
+def format_snippet(raw: Dict) -> str:
+    """Snippet of a document, after the ancestors of its block if any"""
+    if not raw.get('display_breadcrumb'):
+        return raw['snippet']
+    return f"<span class='breadcrumb'>{raw['display_breadcrumb']}</span> " \
+        f"{raw['snippet']}"
+
+
+def format_result(raw: Dict) -> str:
+    """Assembles display fields computed at indexing time
+    (see `roam_sanity.transforms`).
+    The long content is loaded from `/doc/<doc_id>` when it is expanded.
+    Pages with several matching blocks list them instead, each linking to
+    its block."""
+    if raw.get('blocks'):
+        html_content_short = "<ul class='blocks'>" + ''.join(
+            f"<li><a href=\"{block['url']}\" target='_blank'>"
+            f"{format_snippet(block)}</a></li>"
+            for block in raw['blocks']) + '</ul>'
+    else:
+        html_content_short = format_snippet(raw)
+
+    if raw['has_more'] and not raw.get('blocks'):
+        html_content_long = '''
+            <a class='show_more'>[more]</a>
+            <div class='content long'></div>
+            <a class='show_less'>[less]</a>
+        '''
+    else:
+        html_content_long = ''
+
+    url = raw.get('page_url') or raw['url']
+    html = f'''
+        <div class='search_result' data-doc-id="{raw['doc_id']}">
+            <a href="{url}" target='_blank'
+               class='title{" link_missing" if not url else ""}'>
+                <img src="static/img/{raw['source']}.png" alt="{raw['source']}">
+                {raw['display_title']}
+            </a>
+            <span class='time'>({raw['display_date']})</span>
+            <div class='content short'>
+                {html_content_short}
+            </div>
+            {html_content_long}
+        </div>
+    '''
+    return html
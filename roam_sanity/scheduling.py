@@ -0,0 +1,129 @@
+"""Running crawl jobs concurrently, within the rate limits of APIs"""
+
+from typing import (Any, Callable, Iterable, Iterator, List, NamedTuple, Set,
+                    Tuple)
+import time
+import queue
+import threading
+from concurrent.futures import (ThreadPoolExecutor, Future, wait,
+                                FIRST_COMPLETED)
+from loguru import logger
+
+
+class TokenBucket:
+    """Allows `rate` operations per second on average, with bursts of up to
+    `capacity` operations. Thread-safe."""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n: float = 1.):
+        """Waits until `n` operations are allowed"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens
+                                   + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return
+                delay = (n - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+class Job(NamedTuple):
+    """Named function returning items, e.g. the results of a query"""
+    name: str
+    fn: Callable[[], Iterable]
+
+
+_DONE = object()
+
+
+class JobScheduler:
+    """Runs jobs in a pool of `n_workers` threads, and streams their items
+    as they are produced.
+    Failed jobs are retried `n_retries` times, after an exponential backoff.
+    Items produced before a failure are not withdrawn, so a retried job may
+    produce some items twice."""
+    def __init__(self, n_workers: int = 4, n_retries: int = 2,
+                 retry_delay: float = 5., queue_size: int = 1000):
+        self.n_workers = n_workers
+        self.n_retries = n_retries
+        self.retry_delay = retry_delay
+        self.queue_size = queue_size
+        self.failed = []  # type: List[str]
+
+    def run(self, jobs: Iterable[Job]) -> Iterator[Tuple[str, Any]]:
+        """Yields (job name, item) pairs, in the order items are produced"""
+        jobs = list(jobs)
+        results = queue.Queue(maxsize=self.queue_size)  # type: queue.Queue
+        stop = threading.Event()
+
+        def _put(entry: Tuple[str, Any]) -> bool:
+            """Returns False if the consumer has stopped"""
+            while not stop.is_set():
+                try:
+                    results.put(entry, timeout=.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def _run(job: Job):
+            try:
+                for attempt in range(self.n_retries + 1):
+                    if stop.is_set():
+                        return
+                    try:
+                        for item in job.fn():
+                            if not _put((job.name, item)):
+                                return
+                        return
+                    except Exception as e:  # pylint: disable=broad-except
+                        logger.warning(f'Job `{job.name}` failed '
+                                       f'({attempt + 1}/{self.n_retries + 1})'
+                                       f': {e!r}')
+                        if attempt < self.n_retries:
+                            time.sleep(self.retry_delay * 2**attempt)
+                self.failed.append(job.name)
+            finally:
+                _put((job.name, _DONE))
+
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            for job in jobs:
+                executor.submit(_run, job)
+            try:
+                n_done = 0
+                while n_done < len(jobs):
+                    name, item = results.get()
+                    if item is _DONE:
+                        n_done += 1
+                    else:
+                        yield name, item
+            finally:
+                stop.set()
+
+
+def consume_in_threads(items: Iterable, fn: Callable[[Any], None],
+                       n_workers: int = 2, queue_size: int = 16):
+    """Calls `fn` on items in a pool of `n_workers` threads, while items are
+    produced in the calling thread. Producing items blocks while `queue_size`
+    items are waiting. Items already produced are processed before returning,
+    even if producing items fails. Errors of `fn` are logged."""
+    def _run(item: Any):
+        try:
+            fn(item)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to process an item')
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = set()  # type: Set[Future]
+        for item in items:
+            if len(pending) >= n_workers + queue_size:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            pending.add(executor.submit(_run, item))
@@ -0,0 +1,249 @@
+"""
+Local index of the documents already in the corpus, so crawlers can skip
+known items without reading the corpus or querying the search backend.
+
+Documents are identified by their key (`util.doc_id`, the hash of their URL).
+The index is stored in a folder:
+- `keys.bin`: sorted keys, as 28-byte digests, searched through a memory map
+- `log.txt`: keys added since `keys.bin` was written, one per line
+- `bloom.bin`: Bloom filter of all keys, answering most negative lookups
+  without searching `keys.bin`
+
+Adding keys only appends to the log; the log is merged into `keys.bin` when it
+grows large, and on `close`. Several processes can add keys concurrently, but
+only see the keys added by others after reopening the index. Within a
+process, the index is thread-safe.
+"""
+
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+import os
+import mmap
+import fcntl
+import threading
+from pathlib import Path
+from roam_sanity.util import hash_
+
+
+KEY_SIZE = 28  # sha224
+N_HASHES = 7
+BITS_PER_KEY = 10  # About 1% false positives
+MIN_BITS = 2**20
+
+
+class BloomFilter:
+    """Bloom filter of keys. Keys are hashes already, so bit positions are
+    taken from their bytes."""
+    def __init__(self, n_bits: int):
+        self.n_bits = n_bits
+        self.bits = bytearray((n_bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, n_keys: int) -> 'BloomFilter':
+        return cls(max(MIN_BITS, n_keys * BITS_PER_KEY))
+
+    def _positions(self, digest: bytes) -> Iterator[int]:
+        for i in range(N_HASHES):
+            yield int.from_bytes(digest[4 * i:4 * i + 4], 'little') \
+                % self.n_bits
+
+    def add(self, digest: bytes):
+        for pos in self._positions(digest):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, digest: bytes) -> bool:
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(digest))
+
+    def save(self, path: Path):
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(self.n_bits.to_bytes(8, 'little'))
+            f.write(self.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> 'BloomFilter':
+        with open(path, 'rb') as f:
+            bloom = cls(int.from_bytes(f.read(8), 'little'))
+            bloom.bits = bytearray(f.read())
+        return bloom
+
+
+class SeenIndex:
+    """Membership index of document keys, stored in `dir_path`"""
+    def __init__(self, dir_path: Path, merge_threshold: int = 100000):
+        self.dir_path = dir_path
+        self.merge_threshold = merge_threshold
+        self.dir_path.mkdir(parents=True, exist_ok=True)
+
+        self._keys = None  # type: Optional[mmap.mmap]
+        self._n_keys = 0
+        self._recent = set()  # type: Set[bytes]
+        # Merges replace the memory map, while crawler threads look up keys
+        self._lock = threading.RLock()
+        self._open()
+
+    @property
+    def keys_path(self) -> Path:
+        return self.dir_path / 'keys.bin'
+
+    @property
+    def log_path(self) -> Path:
+        return self.dir_path / 'log.txt'
+
+    @property
+    def bloom_path(self) -> Path:
+        return self.dir_path / 'bloom.bin'
+
+    def _open(self):
+        with self._lock:
+            if self._keys is not None:
+                self._keys.close()
+                self._keys = None
+            self._n_keys = 0
+            if self.keys_path.is_file() and self.keys_path.stat().st_size:
+                with open(self.keys_path, 'rb') as f:
+                    self._keys = mmap.mmap(f.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+                self._n_keys = len(self._keys) // KEY_SIZE
+
+            self._recent = set()
+            if self.log_path.is_file():
+                with open(self.log_path, 'r') as f:
+                    self._recent = {bytes.fromhex(line.strip()) for line in f
+                                    if line.strip()}
+
+            if self.bloom_path.is_file():
+                self.bloom = BloomFilter.load(self.bloom_path)
+            else:
+                self.bloom = BloomFilter.for_capacity(self._n_keys)
+                for i in range(self._n_keys):
+                    self.bloom.add(self._keys[i * KEY_SIZE:(i + 1) * KEY_SIZE])
+            for digest in self._recent:
+                self.bloom.add(digest)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._n_keys + len(self._recent)
+
+    def _key_at(self, i: int) -> bytes:
+        """Key `i` of `keys.bin` (empty past the end). The lock must be
+        held."""
+        if self._keys is None or i >= self._n_keys:
+            return b''
+        return self._keys[i * KEY_SIZE:(i + 1) * KEY_SIZE]
+
+    def _search(self, digest: bytes, lo: int = 0) -> int:
+        """Binary search in `keys.bin`, from key `lo`: returns the position
+        of the first key not lower than `digest`. The lock must be held."""
+        hi = self._n_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _in_keys(self, digest: bytes) -> bool:
+        """The lock must be held"""
+        return self._key_at(self._search(digest)) == digest
+
+    def _contains_digest(self, digest: bytes) -> bool:
+        with self._lock:
+            if digest not in self.bloom:
+                return False
+            return digest in self._recent or self._in_keys(digest)
+
+    def contains_key(self, key: str) -> bool:
+        return self._contains_digest(bytes.fromhex(key))
+
+    def contains(self, url: str) -> bool:
+        return self.contains_key(hash_(url))
+
+    def contains_many(self, urls: Iterable[str]) -> List[bool]:
+        """Looks up URLs in a batch: those the Bloom filter doesn't rule out
+        are searched in `keys.bin` in sorted order, each search starting
+        where the previous one ended"""
+        digests = [bytes.fromhex(hash_(url)) for url in urls]
+        res = [False] * len(digests)
+        with self._lock:
+            candidates = []  # type: List[Tuple[bytes, int]]
+            for i, digest in enumerate(digests):
+                if digest not in self.bloom:
+                    continue
+                if digest in self._recent:
+                    res[i] = True
+                else:
+                    candidates.append((digest, i))
+
+            lo = 0
+            for digest, i in sorted(candidates):
+                lo = self._search(digest, lo)
+                res[i] = self._key_at(lo) == digest
+        return res
+
+    def add_keys(self, keys: Iterable[str]):
+        digests = [bytes.fromhex(key) for key in keys]
+        with self._lock:
+            digests = [d for d in digests if not self._contains_digest(d)]
+            if not digests:
+                return
+
+            with open(self.log_path, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(''.join(f'{d.hex()}\n' for d in digests))
+            for digest in digests:
+                self._recent.add(digest)
+                self.bloom.add(digest)
+
+            if len(self._recent) >= self.merge_threshold:
+                self.merge()
+
+    def add_key(self, key: str):
+        self.add_keys([key])
+
+    def add(self, url: str):
+        self.add_keys([hash_(url)])
+
+    def merge(self):
+        """Merges the log into `keys.bin` and saves the Bloom filter"""
+        with self._lock:
+            with open(self.log_path, 'a+') as log:
+                fcntl.flock(log, fcntl.LOCK_EX)
+                log.seek(0)
+                added = {bytes.fromhex(line.strip()) for line in log
+                         if line.strip()}
+
+                keys = set()  # type: Set[bytes]
+                if self.keys_path.is_file():
+                    with open(self.keys_path, 'rb') as f:
+                        content = f.read()
+                    keys = {content[i:i + KEY_SIZE]
+                            for i in range(0, len(content), KEY_SIZE)}
+                if not added - keys and self.bloom_path.is_file():
+                    log.truncate(0)
+                    return
+                keys |= added
+
+                tmp_path = self.keys_path.with_name(
+                    f'{self.keys_path.name}.{os.getpid()}.tmp')
+                with open(tmp_path, 'wb') as f:
+                    f.write(b''.join(sorted(keys)))
+                os.replace(tmp_path, self.keys_path)
+
+                bloom = BloomFilter.for_capacity(2 * len(keys))
+                for digest in keys:
+                    bloom.add(digest)
+                bloom.save(self.bloom_path)
+                log.truncate(0)
+            self._open()
+
+    def close(self):
+        with self._lock:
+            if self._recent:
+                self.merge()
+            if self._keys is not None:
+                self._keys.close()
+                self._keys = None
@@ -0,0 +1,119 @@
+"""
+Ingest-time transforms, computing display fields once per document instead
+of on every search request.
+
+Each source registers a transform that returns its title, the time to
+display and, optionally, the short and long contents. Common fields are then
+derived by `enrich`:
+- `display_title`
+- `snippet`: short content, truncated
+- `display_date`: formatted date, or '' if unknown
+- `timestamp`: epoch time in seconds, or None if unknown
+- `messages`: messages of a thread (only for sources with threads)
+- `display_breadcrumb`: ancestors of a block (only for sources with blocks)
+- `has_more`: whether the long content differs from the snippet
+- `page_url`: url of the page of a block, or of the document itself.
+  Search results are collapsed by page.
+"""
+
+from typing import Callable, Dict, Optional
+import dateutil.parser
+
+
+N_CHARS_DISPLAYED_MAX = 150
+N_CHARS_ADDED_MIN = 150
+N_CHARS_ANCESTOR_MAX = 40
+BREADCRUMB_SEP = ' › '
+MESSAGE_SEP = '<NEXT_MESSAGE>'
+
+TRANSFORMS = {}  # type: Dict[str, Callable[[Dict], Dict]]
+
+
+def register(source: str) -> Callable:
+    """Registers the transform of a source"""
+    def decorator(fn: Callable[[Dict], Dict]) -> Callable[[Dict], Dict]:
+        TRANSFORMS[source] = fn
+        return fn
+    return decorator
+
+
+@register('roam-research')
+def transform_roam(doc: Dict) -> Dict:
+    res = {
+        'title': f"/{doc['database']} {doc['title']}",
+        'time_iso': doc.get('edit_time', doc.get('create_time')),
+    }
+    if 'page_uid' in doc:
+        res['breadcrumb'] = BREADCRUMB_SEP.join(
+            truncate(ancestor, N_CHARS_ANCESTOR_MAX, 0)
+            for ancestor in doc['breadcrumb'])
+    else:
+        # Whole pages, crawled before blocks were indexed, are too long to be
+        # shown as snippets
+        res['content_short'] = ''
+    return res
+
+
+@register('twitter')
+def transform_twitter(doc: Dict) -> Dict:
+    return {
+        'title': f"@{doc['author_screen_name']}",
+        'time_iso': doc.get('create_time'),
+    }
+
+
+@register('slack')
+def transform_slack(doc: Dict) -> Dict:
+    # Display only the first message
+    messages = doc['text'].split(MESSAGE_SEP)
+    return {
+        'title': f"#{doc['channel']}",
+        'time_iso': doc.get('create_time'),
+        'content_short': messages[0],
+        'messages': messages,
+    }
+
+
+def _transform_default(doc: Dict) -> Dict:
+    return {
+        'title': doc['source'],
+        'time_iso': doc.get('create_time'),
+    }
+
+
+def truncate(text: str, n_chars_max: int = N_CHARS_DISPLAYED_MAX,
+             n_chars_added_min: int = N_CHARS_ADDED_MIN) -> str:
+    if len(text) > n_chars_max + n_chars_added_min:
+        return text[:n_chars_max] + '...'
+    return text
+
+
+def enrich(doc: Dict) -> Dict:
+    """Returns a copy of `doc` with display fields"""
+    fields = TRANSFORMS.get(doc['source'], _transform_default)(doc)
+
+    content_short = fields.get('content_short', doc['text'])
+    snippet = truncate(content_short)
+
+    timestamp = None  # type: Optional[float]
+    display_date = ''
+    if fields['time_iso']:
+        dtm = dateutil.parser.parse(fields['time_iso'])
+        timestamp = dtm.timestamp()
+        display_date = dtm.strftime('%m/%d/%y')
+
+    res = dict(doc)
+    res.setdefault('url', '')
+    res.setdefault('page_url', res['url'])
+    res.update({
+        'display_title': fields['title'],
+        'snippet': snippet,
+        'display_date': display_date,
+        'timestamp': timestamp,
+        'has_more': snippet != doc['text'],
+    })
+    if 'messages' in fields:
+        res['messages'] = fields['messages']
+    if 'breadcrumb' in fields:
+        res['display_breadcrumb'] = fields['breadcrumb']
+    return res
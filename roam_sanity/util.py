@@ -1,43 +1,205 @@
-from typing import Iterator, Dict
-import re
+from typing import (Any, Iterator, Iterable, Callable, Dict, List, Optional,
+                    NamedTuple)
 import os
 import json
-from subprocess import Popen, PIPE
+import time
+import threading
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from itertools import islice
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
 from pathlib import Path
 import hashlib
 
+try:
+    import orjson
+    json_loads = orjson.loads  # type: Callable[..., Any]
+except ImportError:
+    json_loads = json.loads
+
 
 def hash_(s: str) -> str:
     """Hash consistent across executions and platforms"""
     return hashlib.sha224(s.encode('utf-8')).hexdigest()
 
 
+def doc_id(doc: Dict) -> str:
+    """Deterministic document id, also used for naming files"""
+    return hash_(doc['url'])
+
+
 def save_as_json(doc: Dict):
     dir_path = Path(os.environ['RSP_DATA_PATH']) / doc['source']
     dir_path.mkdir(parents=True, exist_ok=True)
-    key = hash_(doc['url'])
+    key = doc_id(doc)
 
     with open(dir_path / f'{key}.json', 'w') as f:
         json.dump(doc, f, sort_keys=True, indent='\t')
 
 
 def get_by_extension(path: Path, extension: str) -> Iterator[Path]:
-    """Yields file paths matching an extension, from nested folders"""
-    if path.is_dir():
-        for p in path.iterdir():
-            yield from get_by_extension(p, extension)
-    else:
-        if re.match(r"^.*\.{}$".format(extension), str(path)):
+    """Yields file paths matching an extension, from nested folders.
+    Paths are streamed as directories are scanned. Hidden folders (like
+    `.rsp_checkpoints`) are skipped: they hold the state of tools, not
+    documents."""
+    suffix = f'.{extension}'
+    if not path.is_dir():
+        if path.name.endswith(suffix):
             yield path
+        return
 
+    stack = [str(path)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('.'):
+                        stack.append(entry.path)
+                elif entry.name.endswith(suffix):
+                    yield Path(entry.path)
 
-def run_in_subprocess(cmd: str) -> str:
-    pop = Popen(cmd, shell=True, stdin=PIPE, stderr=PIPE, stdout=PIPE,  # pylint: disable=consider-using-with
-                close_fds=True)
-    pop.wait()
+
+def iter_batches(iterable: Iterable, size: int) -> Iterator[List]:
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+class LoadedFile(NamedTuple):
+    path: Path
+    size: int
+    mtime: float
+    digest: str
+    doc: Optional[Dict]
+    error: Optional[str]
+
+
+def decode_file(path: Path, size: int, mtime: float, content: bytes,
+                transform: Optional[Callable[[Dict], Dict]] = None
+                ) -> LoadedFile:
+    """Decodes and optionally transforms the content of a JSON file"""
+    digest = hashlib.sha224(content).hexdigest()
+    try:
+        doc = json_loads(content)
+        if transform is not None:
+            doc = transform(doc)
+    except (KeyError, TypeError, ValueError) as e:
+        return LoadedFile(path, size, mtime, digest, None, repr(e))
+    return LoadedFile(path, size, mtime, digest, doc, None)
+
+
+def load_json_files(paths: List[Path],
+                    transform: Optional[Callable[[Dict], Dict]] = None
+                    ) -> List[LoadedFile]:
+    """Reads, decodes and optionally transforms JSON files, so it can run in
+    a worker process"""
+    res = []  # type: List[LoadedFile]
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                content = f.read()
+        except OSError as e:
+            res.append(LoadedFile(path, 0, 0., '', None, repr(e)))
+            continue
+
+        res.append(decode_file(path, stat.st_size, stat.st_mtime, content,
+                               transform))
+    return res
+
+
+def run_in_subprocess(cmd: str, timeout: Optional[float] = None) -> str:
+    """Raises SystemError if the command fails, and TimeoutExpired if it
+    runs for more than `timeout` seconds"""
+    with Popen(cmd, shell=True, stdin=PIPE, stderr=PIPE, stdout=PIPE,
+               close_fds=True) as pop:
+        # Reading both pipes while waiting, so the command can't block on
+        # a full pipe
+        try:
+            stdout, stderr = pop.communicate(timeout=timeout)
+        except TimeoutExpired:
+            pop.kill()
+            pop.communicate()
+            raise
     if pop.returncode != 0:
-        raise SystemError(pop.stderr.read().decode('utf-8'))  # type: ignore
-    output = pop.stdout.read().decode('utf-8')  # type: ignore
+        raise SystemError(stderr.decode('utf-8'))
+    output = stdout.decode('utf-8')
     if output and output[-1] == '\n':
         output = output[:-1]
     return output
+
+
+def stream_subprocess(args: List[str], timeout: Optional[float] = None
+                      ) -> Iterator[str]:
+    """Yields the lines of the output of a command as they are produced.
+    stderr is read in the background, so the command can't block on it.
+    The command is killed if it runs for more than `timeout` seconds
+    (raising TimeoutExpired), or if the caller stops iterating.
+    Raises SystemError if the command fails."""
+    pop = Popen(args, stdin=DEVNULL, stderr=PIPE, stdout=PIPE,  # pylint: disable=consider-using-with
+                close_fds=True)
+    stderr = deque(maxlen=100)  # type: deque
+
+    def _read_stderr():
+        for line in pop.stderr:  # type: ignore
+            stderr.append(line)
+
+    stderr_reader = threading.Thread(target=_read_stderr, daemon=True)
+    stderr_reader.start()
+    timed_out = threading.Event()
+
+    def _kill():
+        timed_out.set()
+        pop.kill()
+
+    timer = threading.Timer(timeout, _kill) if timeout is not None else None
+    if timer is not None:
+        timer.start()
+    try:
+        for line in pop.stdout:  # type: ignore
+            yield line.decode('utf-8').rstrip('\n')
+        pop.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if pop.poll() is None:
+            pop.kill()
+            pop.wait()
+        pop.stdout.close()  # type: ignore
+        stderr_reader.join()
+        pop.stderr.close()  # type: ignore
+
+    if timed_out.is_set():
+        raise TimeoutExpired(args, timeout)  # type: ignore
+    if pop.returncode != 0:
+        raise SystemError(b''.join(stderr).decode('utf-8', 'replace'))
+
+
+class StepTimer:
+    """Durations of the steps of a process, to see where its time goes.
+    Thread-safe."""
+    def __init__(self):
+        self.durations = defaultdict(list)  # type: Dict[str, List[float]]
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def step(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                self.durations[name].append(duration)
+
+    def summary(self) -> str:
+        """One line per step, from the longest in total"""
+        with self._lock:
+            durations = sorted(self.durations.items(), key=lambda e: -sum(e[1]))
+        return '\n'.join(
+            f'{name}: {len(e)} x {1000 * sum(e) / len(e):.0f} ms '
+            f'(total {sum(e):.1f} s, max {1000 * max(e):.0f} ms)'
+            for name, e in durations)
@@ -0,0 +1,121 @@
+"""
+Compares the rendering of Roam pages (`crawl_roam.render_page_content`) with
+the former recursive renderer, on synthetic outlines:
+- wide: many blocks with a few levels of nesting
+- deep: a single chain of nested blocks
+- nested: a chain of nested blocks, with sibling blocks at each level
+"""
+
+from typing import List
+import sys
+import time
+import click
+from loguru import logger
+from crawl_roam import render_page_content
+
+
+class Block:
+    """Minimal stand-in for `pyroaman.Block`"""
+    def __init__(self, string: str, children: List['Block']):
+        self.string = string
+        self.children = children
+
+
+def make_wide_page(n_blocks: int, fan_out: int) -> Block:
+    """Page with `n_blocks` blocks, each block having `fan_out` children"""
+    page = Block('Wide page', [])
+    level = [page]
+    count = 0
+    while count < n_blocks:
+        next_level = []
+        for parent in level:
+            for _ in range(fan_out):
+                if count == n_blocks:
+                    break
+                child = Block(f'Block {count} with [[a link]] and some text', [])
+                parent.children.append(child)
+                next_level.append(child)
+                count += 1
+        level = next_level
+    return page
+
+
+def make_deep_page(depth: int) -> Block:
+    """Page with a chain of `depth` nested blocks"""
+    page = Block('Deep page', [])
+    parent = page
+    for i in range(depth):
+        child = Block(f'Block {i} with [[a link]] and some text', [])
+        parent.children.append(child)
+        parent = child
+    return page
+
+
+def make_nested_page(depth: int, fan_out: int) -> Block:
+    """Page with a chain of `depth` nested blocks, each one having
+    `fan_out` children besides the next one"""
+    page = Block('Nested page', [])
+    parent = page
+    for i in range(depth):
+        child = Block(f'Block {i} with [[a link]] and some text', [])
+        parent.children += [Block(f'Block {i}.{j} with some text', [])
+                            for j in range(fan_out)]
+        parent.children.append(child)
+        parent = child
+    return page
+
+
+def render_recursively(page: Block) -> str:
+    """Former renderer, concatenating strings recursively"""
+    def _render_block(block: Block) -> str:
+        html = block.string
+        html += '<ul>'
+        for child in block.children:
+            html += '<li>' + _render_block(child) + '</li>'
+        html += '</ul>'
+        return html
+
+    html = '<ul>'
+    for child in page.children:
+        html += '<li>' + _render_block(child) + '</li>'
+    html += '</ul>'
+    return html
+
+
+def measure(fn, page: Block, n_runs: int) -> float:
+    """Best duration over `n_runs` runs, in seconds"""
+    durations = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        fn(page)
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+@click.command()
+@click.option('--n_blocks', type=int, default=200000, nargs=1, show_default=True, help='Number of blocks of the wide page')
+@click.option('--fan_out', type=int, default=10, nargs=1, show_default=True, help='Number of children per block of the wide page')
+@click.option('--depth', type=int, default=20000, nargs=1, show_default=True, help='Depth of the deep page')
+@click.option('--nested_depth', type=int, default=800, nargs=1, show_default=True, help='Depth of the nested page (under the recursion limit, so the former renderer works)')
+@click.option('--n_runs', type=int, default=3, nargs=1, show_default=True)
+def main(n_blocks: int, fan_out: int, depth: int, nested_depth: int,
+         n_runs: int):
+    pages = {
+        'wide': make_wide_page(n_blocks, fan_out),
+        'deep': make_deep_page(depth),
+        'nested': make_nested_page(nested_depth, fan_out),
+    }
+    for name, page in pages.items():
+        duration = measure(render_page_content, page, n_runs)
+        try:
+            if render_recursively(page) != render_page_content(page):
+                raise AssertionError(f'Renderers differ on the {name} page')
+            former = f'{measure(render_recursively, page, n_runs):.3f} s'
+        except RecursionError:
+            former = f'fails (recursion limit: {sys.getrecursionlimit()})'
+        logger.info(f'{name} page: {duration:.3f} s (former renderer: '
+                    f'{former})')
+
+
+if __name__ == '__main__':
+    main()
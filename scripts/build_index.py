@@ -1,15 +1,42 @@
+from typing import Optional
 import os
 from pathlib import Path
 from loguru import logger
 import click
-from roam_sanity.indexing import index
+from roam_sanity import config
+from roam_sanity.backend import get_backend
 
 
 @click.command()
 @click.option('--data_path', type=str, default=os.environ['RSP_DATA_PATH'] if 'RSP_DATA_PATH' in os.environ else None, nargs=1, show_default=False)
-def main(data_path: str):
-    logger.info('Building Elasticsearch index')
-    index.populate(Path(data_path))
+@click.option('--chunk_size', type=int, default=500, nargs=1, show_default=True, help='Number of documents per bulk request')
+@click.option('--n_workers', type=int, default=4, nargs=1, show_default=True, help='Number of parallel bulk requests')
+@click.option('--n_loaders', type=int, default=None, nargs=1, show_default=False, help='Number of processes reading JSON files [default: number of cores]')
+@click.option('--incremental', is_flag=True, default=False, help='Only index new or changed files, and delete removed ones')
+@click.option('--manifest_path', type=str, default=None, nargs=1, show_default=False, help='Build manifest [default: <data_path>/.rsp_manifest]')
+@click.option('--n_replicas', type=int, default=1, nargs=1, show_default=True, help='Number of replicas of the new index version')
+@click.option('--retention', type=int, default=2, nargs=1, show_default=True, help='Number of index versions to keep, including the live one')
+@click.option('--backend', type=click.Choice(['elasticsearch', 'bm25']), default=config.BACKEND, nargs=1, show_default=True)
+def main(data_path: str, chunk_size: int, n_workers: int,
+         n_loaders: Optional[int], incremental: bool,
+         manifest_path: Optional[str], n_replicas: int, retention: int,
+         backend: str):
+    logger.info(f'Building index ({backend})')
+    report = get_backend(backend).populate(
+        Path(data_path), chunk_size=chunk_size, n_workers=n_workers,
+        n_loaders=n_loaders, incremental=incremental,
+        manifest_path=Path(manifest_path) if manifest_path else None,
+        n_replicas=n_replicas, retention=retention)
+
+    logger.info(f'Indexed {report.n_indexed} documents in '
+                f'{report.elapsed:.1f}s ({report.docs_per_sec:.0f} docs/sec)')
+    if incremental:
+        logger.info(f'Deleted {report.n_deleted} documents, '
+                    f'skipped {report.n_skipped} unchanged files')
+    if report.failures:
+        logger.warning(f'{report.n_failed} documents failed')
+        for failure in report.failures:
+            logger.warning(f"{failure['ref']}: {failure['error']}")
 
 
 if __name__ == '__main__':
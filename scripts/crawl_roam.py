@@ -6,18 +6,20 @@ If you think some other databases should be added, please suggest it on Slack or
 create a Github issue.
 """
 
-from typing import Iterator, Dict
-import tempfile
-import shutil
+from typing import Any, Iterator, Dict, List, Optional, Tuple, Union
+import os
+import json
+import hashlib
 from datetime import datetime
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from six.moves import urllib
 import pytz
 from loguru import logger
 import click
 from tqdm import tqdm
 import pyroaman
-from roam_sanity.util import save_as_json
+from roam_sanity.corpus import save_doc, seen_index, flush_docs
 
 
 DATABASES = [
@@ -25,19 +27,76 @@ DATABASES = [
     'roamhacker',
 ]
 
-parsing_time = datetime.now().astimezone(pytz.utc).isoformat()
+DATABASES_URL = 'https://raw.githubusercontent.com/br-g/roam-public-db/main/json'
 
+# Downloaded databases are kept in `<data_path>/<DOWNLOADS_DIRNAME>`, under
+# other extensions than `.json` so they are never taken for documents
+DOWNLOADS_DIRNAME = '.rsp_downloads/roam'
+DOWNLOAD_SUFFIX = '.download'
+META_SUFFIX = '.meta'
+DOWNLOAD_TIMEOUT = 60
 
-def download_database(db_id: str) -> pyroaman.database:
-    url = f'https://raw.githubusercontent.com/br-g/roam-public-db/main/json/{db_id}.json'
-    dirpath = Path(tempfile.mkdtemp())
-    filepath = dirpath / 'db.json'
+parsing_time = datetime.now().astimezone(pytz.utc).isoformat()
 
-    urllib.request.urlretrieve(url, filepath)
-    db = pyroaman.load(filepath)
-    shutil.rmtree(dirpath)
 
-    return db
+class DownloadCache:
+    """Downloaded files, revalidated with their ETag and modification date,
+    so unchanged files aren't downloaded again. Each file has metadata,
+    including the hash of its content."""
+    def __init__(self, dir_path: Path):
+        self.dir_path = dir_path
+        self.dir_path.mkdir(parents=True, exist_ok=True)
+
+    def path(self, name: str) -> Path:
+        return self.dir_path / f'{name}{DOWNLOAD_SUFFIX}'
+
+    def _meta_path(self, name: str) -> Path:
+        return self.dir_path / f'{name}{META_SUFFIX}'
+
+    def meta(self, name: str) -> Dict[str, Any]:
+        if not self.path(name).is_file() or not self._meta_path(name).is_file():
+            return {}
+        with open(self._meta_path(name), 'r') as f:
+            return json.load(f)
+
+    def set_meta(self, name: str, **values: Any):
+        meta = {**self.meta(name), **values}
+        path = self._meta_path(name)
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path)
+
+    def fetch(self, name: str, url: str) -> Tuple[Path, Dict[str, Any]]:
+        """Returns the path and metadata of the file, downloaded if it
+        changed since it was last downloaded"""
+        meta = self.meta(name)
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        request = urllib.request.Request(url, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) \
+                    as response:
+                path = self.path(name)
+                tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+                digest = hashlib.sha224()
+                with open(tmp_path, 'wb') as f:
+                    for chunk in iter(lambda: response.read(1 << 20), b''):
+                        f.write(chunk)
+                        digest.update(chunk)
+                os.replace(tmp_path, path)
+                self.set_meta(name, etag=response.headers.get('ETag'),
+                              last_modified=response.headers.get('Last-Modified'),
+                              sha224=digest.hexdigest())
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                raise
+            logger.info(f'`{name}` not modified since it was downloaded')
+        return self.path(name), self.meta(name)
 
 
 def timestamp_to_iso(timestamp: int) -> str:
@@ -45,61 +104,140 @@ def timestamp_to_iso(timestamp: int) -> str:
     return datetime.fromtimestamp(timestamp).astimezone(pytz.utc).isoformat()
 
 
+def render_blocks(blocks: List['pyroaman.Block']) -> str:
+    """Generates some HTML: a list of blocks, with their children as nested
+    lists. Iterative and joined once, so deep or large outlines take linear
+    time, without hitting the recursion limit."""
+    parts = ['<ul>']
+    append = parts.append
+    # What remains to render, in reverse order: blocks, and the end tags of
+    # the blocks being rendered
+    stack = list(reversed(blocks))  # type: List[Union[str, pyroaman.Block]]
+    while stack:
+        elem = stack.pop()
+        if isinstance(elem, str):
+            append(elem)
+        elif elem.children:
+            append(f'<li>{elem.string}<ul>')
+            stack.append('</ul></li>')
+            stack.extend(reversed(elem.children))
+        else:
+            append(f'<li>{elem.string}<ul></ul></li>')
+    append('</ul>')
+    return ''.join(parts)
+
+
 def render_block_content(block: 'pyroaman.Block') -> str:
     """Generates some HTML"""
-    html = block.string
-    html += '<ul>'
-    for child in block.children:
-        html += '<li>' + render_block_content(child) + '</li>'
-    html += '</ul>'
-    return html
+    return block.string + render_blocks(block.children)
 
 
 def render_page_content(page: 'pyroaman.Block') -> str:
     """Generates some HTML"""
-    html = '<ul>'
-    for child in page.children:
-        html += '<li>' + render_block_content(child) + '</li>'
-    html += '</ul>'
-    return html
-
-
-def parse_database(db_id: str, db: pyroaman.database) -> Iterator[Dict]:
-    for page in tqdm(db.pages):
-        if 'uid' not in page.metadata:
-            continue
-        if not page.text:
-            continue
-
-        res = {
-            'source': 'roam-research',
-            'database': db_id,
-            'parsing_time': parsing_time,
-            'title': page.string,
-            'url': f"https://roamresearch.com/#/app/{db_id}/page/{page.metadata['uid']}",
-            'text': render_page_content(page)
-        }
-        if 'create-time' in page.metadata:
-            res['create_time'] = timestamp_to_iso(page.metadata['create-time'])
-        if 'edit-time' in page.metadata:
-            res['edit_time'] = timestamp_to_iso(page.metadata['edit-time'])
-
-        yield res
+    return render_blocks(page.children)
+
+
+def page_url(db_id: str, page: 'pyroaman.Block') -> str:
+    return f"https://roamresearch.com/#/app/{db_id}/page/{page.metadata['uid']}"
+
+
+def iter_blocks(page: 'pyroaman.Block'
+                ) -> Iterator[Tuple['pyroaman.Block', List[str]]]:
+    """Yields the blocks of a page, depth first, with the strings of their
+    ancestor blocks. Iterative, like `render_blocks`."""
+    stack = [(block, []) for block in reversed(page.children)
+             ]  # type: List[Tuple[pyroaman.Block, List[str]]]
+    while stack:
+        block, ancestors = stack.pop()
+        yield block, ancestors
+        if block.children:
+            breadcrumb = ancestors + [block.string]
+            stack.extend((child, breadcrumb)
+                         for child in reversed(block.children))
+
+
+def parse_database(db_id: str, db: pyroaman.database,
+                   skip_known: bool = False) -> Iterator[Dict]:
+    """Yields a document per block, with the title, url and uid of its page,
+    and the strings of its ancestor blocks"""
+    pages = [page for page in db.pages
+             if 'uid' in page.metadata and page.text]
+
+    for page in tqdm(pages, desc=db_id):
+        blocks = [(block, ancestors) for block, ancestors in iter_blocks(page)
+                  if 'uid' in block.metadata and block.string.strip()]
+        if skip_known:
+            known = seen_index().contains_many(
+                page_url(db_id, block) for block, _ in blocks)
+            blocks = [e for e, is_known in zip(blocks, known) if not is_known]
+
+        for block, ancestors in blocks:
+            res = {
+                'source': 'roam-research',
+                'database': db_id,
+                'parsing_time': parsing_time,
+                'title': page.string,
+                'page_url': page_url(db_id, page),
+                'page_uid': page.metadata['uid'],
+                'uid': block.metadata['uid'],
+                'url': page_url(db_id, block),  # Blocks can be opened as pages
+                'breadcrumb': ancestors,
+                'text': block.string
+            }
+            # Blocks without timestamps get those of their page
+            for key in ('create-time', 'edit-time'):
+                timestamp = block.metadata.get(key, page.metadata.get(key))
+                if timestamp is not None:
+                    res[key.replace('-', '_')] = timestamp_to_iso(timestamp)
+
+            yield res
+
+
+def crawl_database(db_id: str, skip_known: bool = False, force: bool = False,
+                   base_url: str = DATABASES_URL) -> int:
+    """Downloads, parses and saves a database, block by block, unless it
+    hasn't changed since it was last saved (or if `force`). Returns the
+    number of blocks saved."""
+    logger.info(f'Downloading `{db_id}`')
+    cache = DownloadCache(Path(os.environ['RSP_DATA_PATH']) / DOWNLOADS_DIRNAME)
+    path, meta = cache.fetch(db_id, f'{base_url}/{db_id}.json')
+    if not force and meta.get('saved_sha224') == meta['sha224']:
+        logger.info(f'`{db_id}` is unchanged, skipping it')
+        return 0
+
+    logger.info(f'Parsing and saving `{db_id}`')
+    db = pyroaman.load(path)
+    count = 0
+    for doc in parse_database(db_id, db, skip_known):
+        save_doc(doc)
+        count += 1
+    flush_docs()
+    cache.set_meta(db_id, saved_sha224=meta['sha224'])
+    return count
 
 
 @click.command()
-def main():
-    for db_id in DATABASES:
-        logger.info(f'Downloading `{db_id}`')
-        db = download_database(db_id)
-
-        logger.info(f'Parsing `{db_id}`')
-        parsed = list(parse_database(db_id, db))
-        logger.info(f'Collected {len(parsed)} pages')
-
-        logger.info(f'Saving `{db_id}`')
-        for p in parsed:
-            save_as_json(p)
+@click.option('--skip_known', is_flag=True, default=False, help="Skip blocks that are already in the corpus (their edits won't be collected)")
+@click.option('--n_workers', type=int, default=None, nargs=1, show_default=False, help='Number of databases crawled in parallel [default: number of databases]')
+@click.option('--force', is_flag=True, default=False, help='Parse and save databases even if they are unchanged')
+@click.option('--base_url', type=str, default=DATABASES_URL, nargs=1, show_default=True, help='Where to download `<database>.json` files from')
+def main(skip_known: bool, n_workers: Optional[int], force: bool,
+         base_url: str):
+    seen_index()  # Built once, before workers use it
+
+    # Each database is crawled in its own process
+    with ProcessPoolExecutor(max_workers=n_workers or len(DATABASES)) \
+            as executor:
+        futures = {executor.submit(crawl_database, db_id, skip_known, force,
+                                   base_url): db_id
+                   for db_id in DATABASES}
+        for future in as_completed(futures):
+            db_id = futures[future]
+            try:
+                logger.info(f'Collected {future.result()} blocks from '
+                            f'`{db_id}`')
+            except Exception as e:
+                logger.error(f'Failed to crawl `{db_id}`: {e!r}')
 
 
 if __name__ == '__main__':
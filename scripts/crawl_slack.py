@@ -3,39 +3,113 @@ Scraps the Slack Web interface.
 Goes to the 'All unreads' section, opens threads one by one and saves their content.
 """
 
-from typing import Dict, Iterator, Callable, Optional, Any, Set
+from typing import (AbstractSet, Dict, Iterator, Callable, Optional, Any, Set,
+                    Tuple)
 import os
+import re
 import time
 import functools
+import threading
+from pathlib import Path
 from datetime import datetime
 import pytz
 import click
 from loguru import logger
 from bs4 import BeautifulSoup
 from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import NoSuchElementException, TimeoutException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
 from webdriver_manager.chrome import ChromeDriverManager
-from roam_sanity.util import save_as_json
+from roam_sanity.corpus import save_doc, seen_index
+from roam_sanity.util import StepTimer, hash_
+from roam_sanity.checkpoints import Checkpoints
+from roam_sanity.scheduling import consume_in_threads
+
+try:
+    import lxml  # pylint: disable=unused-import
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+SLACK_URL = 'https://roamresearch.slack.com/'
+
+# Maximum durations of waits for the UI, in seconds
+PAGE_TIMEOUT = 30  # Loading the Slack client
+STEP_TIMEOUT = 10  # Reacting to an action
+OPTIONAL_TIMEOUT = 2  # Pop-ups that may not show up at all
+POLL_INTERVAL = 0.1
+
+# Number of threads between saves of the checkpoint
+CHECKPOINT_INTERVAL = 20
+
+# Threads that couldn't be parsed are saved in `<data_path>/<FAILED_DIRNAME>`
+FAILED_DIRNAME = '.rsp_failed/slack'
 
 parsing_time = datetime.now().astimezone(pytz.utc).isoformat()
 
 
 def run_and_retry(fn: Callable, delay=1, n_try=5) -> Any:
+    """Waits `delay` seconds after the first failure, and twice as long after
+    each of the next ones"""
     for try_idx in range(n_try):
         if try_idx > 0:
             logger.warning(f'Retrying ({try_idx}/{n_try-1})...')
+            time.sleep(delay * 2**(try_idx - 1))
         try:
             return fn()
         except Exception as e:
             logger.error(e)
-        finally:
-            time.sleep(delay)
 
     raise SystemError(f'Failed to run `{fn}`')
 
 
+def wait_for(driver, condition: Callable, timeout: float = STEP_TIMEOUT):
+    """Returns the result of `condition` (e.g. an element) as soon as it is
+    truthy. Raises TimeoutException after `timeout` seconds."""
+    return WebDriverWait(driver, timeout, poll_frequency=POLL_INTERVAL) \
+        .until(condition)
+
+
+def wait_for_page(driver, timeout: float = PAGE_TIMEOUT):
+    wait_for(driver, lambda d: d.execute_script('return document.readyState')
+             == 'complete', timeout)
+
+
+def click_if_shown(driver, by: str, selector: str,
+                   timeout: float = OPTIONAL_TIMEOUT) -> bool:
+    """Clicks an element if it shows up within `timeout` seconds"""
+    try:
+        wait_for(driver, EC.element_to_be_clickable((by, selector)),
+                 timeout).click()
+        return True
+    except TimeoutException:
+        return False
+
+
+def url_fingerprint(url: str) -> Optional[str]:
+    """`<channel id>:<timestamp>`, from the URL of a message"""
+    m = re.search(r'/archives/(\w+)/p(\d+)', url)
+    return f'{m.group(1)}:{m.group(2)}' if m else None
+
+
 def scrap_slack(slack_email: str, slack_password: str, mark_as_read: bool,
-                debug: bool) -> Iterator[str]:
+                debug: bool, skip_known: bool = False,
+                slack_url: str = SLACK_URL,
+                timer: Optional[StepTimer] = None,
+                skip: AbstractSet[str] = frozenset()
+                ) -> Iterator[Tuple[str, str]]:
+    """Yields the fingerprints and HTML of threads, except the ones whose
+    fingerprint is in `skip`. `slack_url` can be a local mock of the Slack UI,
+    in which case signing in is skipped if there is no sign-in form.
+    The durations of steps are recorded by `timer`."""
+    timer = timer or StepTimer()
+
+    # Fingerprints and URLs of the messages on the page, by element, so they
+    # are read once per message
+    message_infos = {}  # type: Dict[str, Tuple[str, Optional[str]]]
+
     def get_driver():
         chrome_options = webdriver.ChromeOptions()
         if not debug:
@@ -47,73 +121,67 @@ def scrap_slack(slack_email: str, slack_password: str, mark_as_read: bool,
 
     def open_slack(driver):
         logger.info('Opening Slack')
-        driver.get('https://roamresearch.slack.com/')
-        time.sleep(3)
+        driver.get(slack_url)
+        wait_for_page(driver)
 
     def sign_in(driver):
+        if not driver.find_elements_by_css_selector('input#email'):
+            logger.info('Already signed in')
+            return
+
         logger.info('Signing in')
         driver.find_element_by_css_selector('input#email').send_keys(slack_email)
         driver.find_element_by_css_selector('input#password').send_keys(slack_password)
-        time.sleep(1)
 
         # Accept cookies (only in the EU)
-        try:
-            driver.find_element_by_css_selector('button#onetrust-accept-btn-handler').click()
-            time.sleep(1)
-        except NoSuchElementException:
-            pass
+        click_if_shown(driver, By.CSS_SELECTOR,
+                       'button#onetrust-accept-btn-handler')
 
-        driver.find_element_by_css_selector('button#signin_btn').click()
-        time.sleep(5)
+        signin_button = driver.find_element_by_css_selector('button#signin_btn')
+        signin_button.click()
+        wait_for(driver, EC.staleness_of(signin_button), PAGE_TIMEOUT)
 
         logger.info('Closing pop-ups')
         driver.execute_script('window.open()')
         driver.switch_to.window(driver.window_handles[1])
-        driver.get('https://roamresearch.slack.com/')
-        time.sleep(5)
-        try:
-            driver.find_element_by_css_selector('button.p-download_modal__not_now').click()
-        except NoSuchElementException:
-            # Sometimes, the pop-up is not there
-            pass
-        time.sleep(5)
+        driver.get(slack_url)
+        wait_for_page(driver)
 
-        # Close "Learn more" message
-        try:
-            run_and_retry(
-                driver.find_element_by_css_selector('button.c-button-unstyled.c-icon_button.c-icon_button--light.c-icon_button--size_medium.c-coachmark__close').click
-            )
-        except NoSuchElementException:
-            pass
+        # Sometimes, the pop-up is not there
+        click_if_shown(driver, By.CSS_SELECTOR,
+                       'button.p-download_modal__not_now')
 
-        time.sleep(3)
+        # Close "Learn more" message
+        click_if_shown(driver, By.CSS_SELECTOR,
+                       'button.c-button-unstyled.c-icon_button.c-icon_button--light.c-icon_button--size_medium.c-coachmark__close')
 
     def open_all_unreads(driver):
         logger.info("Opening 'All reads' section")
 
-        try:
-            run_and_retry(
-                driver.find_element_by_xpath("//*[text()='More']").click
-            )
-        except NoSuchElementException:
-            run_and_retry(
-                driver.find_element_by_xpath("//*[text()='Browse Slack']").click
-            )
-
-        driver.find_element_by_xpath("//div[text()='All unreads']").click()
-        time.sleep(3)
+        run_and_retry(lambda: wait_for(driver, EC.element_to_be_clickable(
+            (By.XPATH, "//*[text()='More' or text()='Browse Slack']")),
+            PAGE_TIMEOUT).click())
+        run_and_retry(lambda: wait_for(driver, EC.element_to_be_clickable(
+            (By.XPATH, "//div[text()='All unreads']"))).click())
 
         # Remove header, so we can see messages' top lines
-        header = driver.find_element_by_css_selector('div.p-view_header')
+        header = wait_for(driver, EC.presence_of_element_located(
+            (By.CSS_SELECTOR, 'div.p-view_header')))
         driver.execute_script("arguments[0].style.display = 'none';", header)
-        time.sleep(0.5)
+        wait_for(driver, EC.presence_of_element_located(
+            (By.CSS_SELECTOR, 'div.c-message_kit__gutter__right')))
 
     def do_mark_as_read(driver):
-        try:
-            driver.find_element_by_xpath("//button[text()='Mark All Messages Read']").click()
-        except NoSuchElementException:
+        if not click_if_shown(driver, By.XPATH,
+                              "//button[text()='Mark All Messages Read']",
+                              STEP_TIMEOUT):
             logger.warning("Can't find button 'Mark All Messages Read'")
-        time.sleep(1)
+            return
+        try:
+            wait_for(driver, EC.invisibility_of_element_located(
+                (By.XPATH, "//button[text()='Mark All Messages Read']")))
+        except TimeoutException:
+            logger.warning("Messages may not be marked as read")
 
     def _fix_html(html):
         """I don't really understand why this is needed"""
@@ -124,15 +192,38 @@ def scrap_slack(slack_email: str, slack_password: str, mark_as_read: bool,
         action = webdriver.ActionChains(driver)
         action.move_to_element(message)
         action.perform()
-        time.sleep(1)
-        driver.find_element_by_css_selector('i.c-icon--comment-alt').click()
+        wait_for(driver, EC.element_to_be_clickable(
+            (By.CSS_SELECTOR, 'i.c-icon--comment-alt'))).click()
 
     def _get_thread_html(driver):
+        # Once the messages of the thread are loaded
+        wait_for(driver, EC.presence_of_element_located(
+            (By.CSS_SELECTOR, '.p-flexpane--iap1 div.c-message_kit__gutter')))
         return driver.find_element_by_css_selector('.p-flexpane--iap1').get_attribute('outerHTML')
 
     def _close_thread(driver):
         driver.find_element_by_css_selector('button.p-flexpane_header__control').click()
-        time.sleep(1)
+        wait_for(driver, EC.invisibility_of_element_located(
+            (By.CSS_SELECTOR, '.p-flexpane--iap1')))
+
+    def _message_info(message) -> Tuple[str, Optional[str]]:
+        """Returns the fingerprint of a message (its channel and timestamp, or
+        a short hash of its HTML if it has no link), and its URL"""
+        if message.id not in message_infos:
+            try:
+                url = message.find_element_by_css_selector('a.c-timestamp').get_attribute('href')
+            except NoSuchElementException:
+                url = None
+            fingerprint = url_fingerprint(url) if url else None
+            if fingerprint is None:
+                fingerprint = hash_(_fix_html(message.get_attribute('outerHTML')))[:16]
+            message_infos[message.id] = (fingerprint, url)
+        return message_infos[message.id]
+
+    def _is_known(message) -> bool:
+        """Returns whether the thread of a message is already in the corpus"""
+        _, url = _message_info(message)
+        return url is not None and seen_index().contains(url)
 
     def _is_end(driver) -> bool:
         """Returns whether the `Mark All Messages Read` is visible"""
@@ -142,7 +233,18 @@ def scrap_slack(slack_email: str, slack_password: str, mark_as_read: bool,
         except:
             return False
 
-    def open_and_save_threads(driver) -> Iterator[str]:
+    def _remove_message(driver, message):
+        """Removes messages when done with them"""
+        try:
+            driver.execute_script('''
+                var element = arguments[0];
+                element.parentNode.removeChild(element);
+                ''', message)
+        except:
+            logger.warning("Can't remove message.")
+        message_infos.pop(message.id, None)
+
+    def open_and_save_threads(driver) -> Iterator[Tuple[str, str]]:
         logger.info('Opening and saving threads')
 
         seen = set()  # type: Set[str]
@@ -152,19 +254,18 @@ def scrap_slack(slack_email: str, slack_password: str, mark_as_read: bool,
             # If we have reached the end of messages, stop
             if not messages:
                 logger.warning("Can't find messages anymore")
-                time.sleep(1)
                 return
 
-            if (seen and _fix_html(messages[-1].get_attribute('outerHTML')) in seen):
+            if seen and _message_info(messages[-1])[0] in seen:
                 assert _is_end(driver), 'No more messages, but the ' \
                                         '`Mark All Messages Read` sign is missing'
                 logger.info('Completed `All unreads` section')
-                time.sleep(1)
                 return
 
             for message in messages:
                 # We may have already seen this message
-                if _fix_html(message.get_attribute('outerHTML')) in seen:
+                fingerprint, _ = _message_info(message)
+                if fingerprint in seen:
                     continue
 
                 # Remove headers, so we can see messages' top lines
@@ -174,57 +275,69 @@ def scrap_slack(slack_email: str, slack_password: str, mark_as_read: bool,
                       elems[i].style.display = 'none';
                     }
                 """)
-                time.sleep(0.5)
 
                 # Align message to the top and open thread
                 driver.execute_script('arguments[0].scrollIntoView();', message)
-                seen.add(_fix_html(message.get_attribute('outerHTML')))
-                time.sleep(1)
+                seen.add(fingerprint)
+                if fingerprint in skip:
+                    logger.info('Skipping thread saved by the last crawl')
+                    with timer.step('remove'):
+                        _remove_message(driver, message)
+                    break
+                if skip_known and _is_known(message):
+                    logger.info('Skipping known thread')
+                    with timer.step('remove'):
+                        _remove_message(driver, message)
+                    break
 
                 # Sometimes, the following fails randomly.
                 # We try multiple times and then skip eventually.
                 try:
-                    run_and_retry(
-                        functools.partial(_open_thread, driver, message)
-                    )
+                    with timer.step('open'):
+                        run_and_retry(
+                            functools.partial(_open_thread, driver, message)
+                        )
                 except SystemError:
                     logger.warning("Can't open thread. Skipping.")
+                    with timer.step('remove'):
+                        _remove_message(driver, message)
+                    break
 
                 try:
-                    html = run_and_retry(
-                        functools.partial(_get_thread_html, driver)
-                    )
-                    yield html
+                    with timer.step('get_html'):
+                        html = run_and_retry(
+                            functools.partial(_get_thread_html, driver)
+                        )
+                    yield fingerprint, html
                 except SystemError:
                     logger.warning("Can't get thread's HTML. Skipping.")
                 finally:
-                    time.sleep(0.5)
                     try:
-                        _close_thread(driver)
+                        with timer.step('close'):
+                            _close_thread(driver)
                     except:
                         logger.warning("Can't close thread.")
 
-                # Remove messages when done with them
-                try:
-                    driver.execute_script('''
-                        var element = arguments[0];
-                        element.parentNode.removeChild(element);
-                        ''', message)
-                except:
-                    logger.warning("Can't remove message.")
+                with timer.step('remove'):
+                    _remove_message(driver, message)
 
                 break
 
 
     driver = get_driver()
-    open_slack(driver)
-    sign_in(driver)
-    open_all_unreads(driver)
-    yield from open_and_save_threads(driver)
+    try:
+        with timer.step('sign_in'):
+            open_slack(driver)
+            sign_in(driver)
+        with timer.step('open_all_unreads'):
+            open_all_unreads(driver)
+        yield from open_and_save_threads(driver)
 
-    if mark_as_read:
-        do_mark_as_read(driver)
-    driver.close()
+        if mark_as_read:
+            do_mark_as_read(driver)
+    finally:
+        logger.info(f'Time per step:\n{timer.summary()}')
+        driver.close()
 
 
 def timestamp_to_iso(timestamp: float) -> str:
@@ -241,7 +354,7 @@ def clean_up_text(text: str) -> str:
 
 
 def parse_html_thread(html: str) -> Optional[Dict]:
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = BeautifulSoup(html, HTML_PARSER)
     channel_name = soup.find('span', {'class': ['c-channel_entity__name']}).text
     messages = soup.find_all('div', {'class': ['c-message_kit__gutter']})
 
@@ -278,22 +391,102 @@ def parse_html_thread(html: str) -> Optional[Dict]:
     }
 
 
+def failed_dir() -> Path:
+    return Path(os.environ['RSP_DATA_PATH']) / FAILED_DIRNAME
+
+
+def save_failed(fingerprint: str, html: str, error: Exception):
+    """Saves the HTML of a thread that couldn't be parsed, and the error, so
+    it can be parsed again with `--replay`"""
+    dir_path = failed_dir()
+    dir_path.mkdir(parents=True, exist_ok=True)
+    name = fingerprint.replace(':', '_')
+    with open(dir_path / f'{name}.html', 'w') as f:
+        f.write(html)
+    with open(dir_path / f'{name}.error', 'w') as f:
+        f.write(f'{error!r}\n')
+
+
+def replay_failed():
+    """Parses the threads that couldn't be parsed again, e.g. after fixing
+    `parse_html_thread`"""
+    n_saved = 0
+    paths = sorted(failed_dir().glob('*.html')) if failed_dir().is_dir() else []
+    for path in paths:
+        with open(path, 'r') as f:
+            html = f.read()
+        try:
+            parsed = parse_html_thread(html)
+        except Exception as e:
+            logger.warning(f"Can't parse {path}: {e!r}")
+            continue
+
+        if parsed:
+            save_doc(parsed)
+            n_saved += 1
+        path.unlink()
+        if path.with_suffix('.error').is_file():
+            path.with_suffix('.error').unlink()
+    logger.info(f'Saved {n_saved} threads ({len(paths)} to replay)')
+
+
 @click.command()
 @click.option('--slack_email', type=str, default=os.environ['RSP_SLACK_EMAIL'] if 'RSP_SLACK_EMAIL' in os.environ else None, nargs=1, show_default=False)
 @click.option('--slack_password', type=str, default=os.environ['RSP_SLACK_PASSWORD'] if 'RSP_SLACK_PASSWORD' in os.environ else None, nargs=1, show_default=False)
 @click.option('--mark_as_read', type=bool, default=False, nargs=1, show_default=True)
 @click.option('--debug', type=bool, default=True, nargs=1, show_default=True)
-def main(slack_email: str, slack_password: str, mark_as_read: bool, debug: bool):
-    for html in scrap_slack(slack_email, slack_password, mark_as_read, debug):
+@click.option('--skip_known', is_flag=True, default=False, help="Don't open threads that are already in the corpus (their new replies won't be collected)")
+@click.option('--slack_url', type=str, default=SLACK_URL, nargs=1, show_default=True, help='e.g. a local mock of the Slack UI (file://...)')
+@click.option('--n_workers', type=int, default=2, nargs=1, show_default=True, help='Number of threads parsing and saving threads')
+@click.option('--replay', is_flag=True, default=False, help="Only parse the threads that couldn't be parsed before")
+def main(slack_email: str, slack_password: str, mark_as_read: bool, debug: bool,
+         skip_known: bool, slack_url: str, n_workers: int, replay: bool):
+    if replay:
+        replay_failed()
+        return
+
+    # Threads done by the last crawl, if it was interrupted
+    checkpoints = Checkpoints.for_crawler('slack')
+    done = set(checkpoints.get('done') or [])  # type: Set[str]
+    if done:
+        logger.info(f'Resuming the last crawl ({len(done)} threads done)')
+
+    seen_index()  # Loaded before workers start using it
+    lock = threading.Lock()
+
+    def process_thread(thread: Tuple[str, str]):
+        """Parses and saves a thread, off the thread driving the browser"""
+        fingerprint, html = thread
         try:
             parsed = parse_html_thread(html)
-        except:
-            logger.warning("Can't parse message.")
-            continue
-
-        if parsed:
-            save_as_json(parsed)
-
+        except Exception as e:
+            logger.warning(f"Can't parse thread {fingerprint} ({e!r}). Saved "
+                           f"for replay.")
+            save_failed(fingerprint, html, e)
+            parsed = None
+
+        with lock:
+            if parsed:
+                save_doc(parsed)
+            done.add(fingerprint)
+            # Sorted only when saved, so long crawls stay linear
+            if len(done) % CHECKPOINT_INTERVAL == 0:
+                checkpoints.set('done', sorted(done))
+                checkpoints.save()
+
+    # Threads are parsed and saved while the next ones are being scraped
+    completed = False
+    try:
+        consume_in_threads(
+            scrap_slack(slack_email, slack_password, mark_as_read, debug,
+                        skip_known, slack_url, skip=frozenset(done)),
+            process_thread, n_workers=n_workers)
+        completed = True
+    finally:
+        # Once completed, the next crawl starts over
+        with lock:
+            checkpoints.set('done', [] if completed else sorted(done))
+            checkpoints.save()
 
 if __name__ == '__main__':
     main()
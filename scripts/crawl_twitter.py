@@ -19,12 +19,14 @@ sometimes, the CLI. All in all, this seems to be working properly.
 You can get Twitter credentials here: https://developer.twitter.com/en/docs/twitter-api
 """
 
-from typing import Dict, List, Iterator, Tuple, Optional
+from typing import (Callable, Dict, Iterable, List, Iterator, NamedTuple,
+                    Tuple, Optional)
 import os
 import re
+import functools
+import threading
+import shlex
 from datetime import datetime, timedelta
-import tempfile
-import shutil
 import json
 from pathlib import Path
 import pytz
@@ -33,7 +35,10 @@ import twint
 import twitter
 from tqdm import tqdm
 from loguru import logger
-from roam_sanity.util import run_in_subprocess, save_as_json
+from roam_sanity.util import stream_subprocess, iter_batches
+from roam_sanity.corpus import save_doc, seen_index
+from roam_sanity.scheduling import TokenBucket, Job, JobScheduler
+from roam_sanity.checkpoints import Checkpoints
 
 
 HASHTAGS = [
@@ -49,8 +54,28 @@ USERNAMES = [
     'RoamResearch',
 ]
 
+# Limit of `statuses/lookup` (with user authentication): 900 requests per 15
+# minutes, of up to 100 tweets each. A bucket allows its burst on top of the
+# requests refilled during a window, so both add up to the limit.
+API_WINDOW = 15 * 60
+API_BURST = 10
+API_RATE = (900 - API_BURST) / API_WINDOW
+LOOKUP_BATCH_SIZE = 100
+
+# Maximum duration of a query through the Twint CLI, in seconds
+TWINT_CLI_TIMEOUT = 15 * 60
+
+TWEET_CACHE_FILENAME = '.rsp_tweets.jsonl'
+
 parsing_time = datetime.now().astimezone(pytz.utc).isoformat()
 api = None
+api_bucket = TokenBucket(API_RATE, API_BURST)
+tweet_cache = None  # type: Optional[TweetCache]
+checkpoints = None  # type: Optional[Checkpoints]
+
+# The twint package keeps results in module globals, so its searches can't
+# run concurrently
+twint_lock = threading.Lock()
 
 
 def get_date_intervals(n_days: int) -> Iterator[Tuple[str, str]]:
@@ -70,9 +95,11 @@ def url_to_tweet_id(url: str) -> int:
     return int(m.group(1))
 
 
-def get_tweet(tweet_id: int) -> twitter.models.Status:
+def lookup_tweets(tweet_ids: List[str]) -> List[twitter.models.Status]:
+    """Returns the tweets that still exist, in a single request"""
     assert api
-    return api.GetStatus(tweet_id)
+    api_bucket.acquire()
+    return api.LookupStatuses([int(e) for e in tweet_ids])
 
 
 def format_api_tweet(tweet: twitter.models.Status) -> Iterator[Dict]:
@@ -95,6 +122,124 @@ def format_api_tweet(tweet: twitter.models.Status) -> Iterator[Dict]:
     }
 
 
+class Hydrated(NamedTuple):
+    """Tweet looked up through the API, with the tweet it retweets if any"""
+    tweet: Dict
+    retweeted: Optional[Dict]
+
+
+class TweetCache:
+    """Tweets looked up through the API by id, stored in a JSONL file so each
+    tweet is looked up once, across runs. Tweets that don't exist anymore (or
+    are private) are stored as None, so they aren't looked up again either.
+    Thread-safe: tweets being looked up by a thread are waited for by others
+    instead of being looked up twice."""
+    def __init__(self, path: Path):
+        self.path = path
+        self._entries = {}  # type: Dict[str, Optional[Hydrated]]
+        self._pending = {}  # type: Dict[str, threading.Event]
+        self._lock = threading.Lock()
+
+        if path.is_file():
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # Interrupted while writing
+                        continue
+                    self._entries[entry['id']] = \
+                        Hydrated(**entry['tweet']) if entry['tweet'] else None
+
+    def _add(self, entries: Dict[str, Optional[Hydrated]]):
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(''.join(
+                    json.dumps({'id': k, 'tweet': v._asdict() if v else None})
+                    + '\n' for k, v in entries.items()))
+            self._entries.update(entries)
+
+    def hydrate(self, tweet_ids: Iterable[str]
+                ) -> Dict[str, Optional[Hydrated]]:
+        """Returns tweets by id, looking up the unknown ones in batches.
+        Tweets that couldn't be looked up are None."""
+        tweet_ids = set(tweet_ids)
+        to_lookup = []
+        others = []
+        event = threading.Event()
+        with self._lock:
+            for tweet_id in tweet_ids:
+                if tweet_id in self._entries:
+                    continue
+                if tweet_id in self._pending:
+                    others.append(self._pending[tweet_id])
+                else:
+                    self._pending[tweet_id] = event
+                    to_lookup.append(tweet_id)
+
+        try:
+            for batch in iter_batches(sorted(to_lookup), LOOKUP_BATCH_SIZE):
+                found = {e.id_str: e for e in lookup_tweets(batch)}
+                self._add({tweet_id: hydrate_api_tweet(found[tweet_id])
+                           if tweet_id in found else None
+                           for tweet_id in batch})
+        finally:
+            with self._lock:
+                for tweet_id in to_lookup:
+                    del self._pending[tweet_id]
+            event.set()
+
+        for other in others:
+            other.wait()
+        with self._lock:
+            return {e: self._entries.get(e) for e in tweet_ids}
+
+
+def get_tweet_cache() -> TweetCache:
+    global tweet_cache  # pylint: disable=global-statement
+    if tweet_cache is None:
+        tweet_cache = TweetCache(Path(os.environ['RSP_DATA_PATH'])
+                                 / TWEET_CACHE_FILENAME)
+    return tweet_cache
+
+
+def hydrate_api_tweet(tweet: twitter.models.Status) -> Hydrated:
+    retweeted = tweet.retweeted_status  # pylint: disable=no-member
+    return Hydrated(next(format_api_tweet(tweet)),
+                    next(format_api_tweet(retweeted)) if retweeted else None)
+
+
+def format_twint_tweets(raws: List[Dict]) -> Iterator[Dict]:
+    """Formats tweets found by Twint, with the tweets they retweet or quote,
+    which are looked up through the API"""
+    def _quoted_id(raw: Dict) -> Optional[str]:
+        # Skipped if we already have it
+        if not raw['quote_url'] or seen_index().contains(raw['quote_url']):
+            return None
+        try:
+            return str(url_to_tweet_id(raw['quote_url']))
+        except ValueError:
+            return None
+
+    retweet_ids = [str(raw['id']) if raw['retweet'] else None for raw in raws]
+    quoted_ids = [_quoted_id(raw) for raw in raws]
+    hydrated = get_tweet_cache().hydrate(
+        e for e in retweet_ids + quoted_ids if e is not None)
+
+    for raw, retweet_id, quoted_id in zip(raws, retweet_ids, quoted_ids):
+        # If retweet, consider the retweeted tweet instead
+        if retweet_id is not None:
+            retweet = hydrated[retweet_id]
+            if retweet and retweet.retweeted:
+                yield dict(retweet.retweeted, parsing_time=parsing_time)
+        else:
+            yield from format_twint_tweet(raw)
+
+        # If there is a quote, also get the quoted tweet
+        quoted = hydrated[quoted_id] if quoted_id is not None else None
+        if quoted:
+            yield dict(quoted.tweet, parsing_time=parsing_time)
+
+
 def format_twint_tweet(raw: Dict) -> Iterator[Dict]:
     def _date_to_iso(date: str) -> str:
         """The following is for the Paris timezone. You may need to change it."""
@@ -108,74 +253,54 @@ def format_twint_tweet(raw: Dict) -> Iterator[Dict]:
 
         return pytz.timezone('Europe/Paris').localize(dtm).isoformat()
 
-    # If retweet, consider the retweeted tweet instead
-    if raw['retweet']:
-        try:
-            yield from format_api_tweet(get_tweet(raw['id']).retweeted_status)  # pylint: disable=no-member
-        except twitter.error.TwitterError:  # If the tweet has been deleted
-            pass
-    else:
-        yield {
-            'source': 'twitter',
-            'parsing_time': parsing_time,
-            'create_time': _date_to_iso(raw['date']),
-            'id': raw['id'],
-            'conversation_id': raw['conversation_id'],
-            'text': clean_up_text(raw['tweet']),
-            'url': raw['link'],
-            'author_screen_name': raw['username'],
-            'author_name': raw['name'],
-            'user_id': raw['user_id'],
-            'lang': raw['language'],
-            'urls': raw['urls'],
-            'photos': raw['photos'],
-            'hashtags': raw['hashtags'],
-            'quote_url': raw['quote_url'],
-            'video': raw['video'],
-            'thumbnail': raw['thumbnail'],
-            'user_rt_id': raw['user_rt_id'],
-            'reply_to': [e['screen_name'] for e in raw['reply_to']],
-        }
-
-    # If there is a quote, also get the quoted tweet
-    if raw['quote_url']:
-        try:
-            quoted_id = url_to_tweet_id(raw['quote_url'])
-        except ValueError:
-            return
-        try:
-            yield from format_api_tweet(get_tweet(quoted_id))
-        except twitter.error.TwitterError:  # If the tweet has been deleted
-            return
+    yield {
+        'source': 'twitter',
+        'parsing_time': parsing_time,
+        'create_time': _date_to_iso(raw['date']),
+        'id': raw['id'],
+        'conversation_id': raw['conversation_id'],
+        'text': clean_up_text(raw['tweet']),
+        'url': raw['link'],
+        'author_screen_name': raw['username'],
+        'author_name': raw['name'],
+        'user_id': raw['user_id'],
+        'lang': raw['language'],
+        'urls': raw['urls'],
+        'photos': raw['photos'],
+        'hashtags': raw['hashtags'],
+        'quote_url': raw['quote_url'],
+        'video': raw['video'],
+        'thumbnail': raw['thumbnail'],
+        'user_rt_id': raw['user_rt_id'],
+        'reply_to': [e['screen_name'] for e in raw['reply_to']],
+    }
 
 
 def query_twint_cli(cmd: str, since: Optional[str] = None,
                     until: Optional[str] = None) -> Iterator[Dict]:
-    dirpath = Path(tempfile.mkdtemp())
-    filepath = dirpath / 'res.jsonl'
-
-    full_cmd = f'{cmd} -o {filepath} --json --hide-output'
+    """Yields tweets as Twint finds them"""
+    # Twint writes each tweet to the output as it finds them. It considers
+    # outputs without a dot to be folders, hence the `.`
+    full_cmd = f'{cmd} -o /dev/./stdout --json --hide-output'
 
     if since:
         full_cmd += f' --since {since}'
     if until:
         full_cmd += f' --until {until}'
 
-    run_in_subprocess(full_cmd)
-
-    # No results
-    if not filepath.is_file():
-        return
-
-    with open(filepath) as f:
-        for line in f:
-            yield from format_twint_tweet(json.loads(line))
-
-    shutil.rmtree(dirpath)
+    for line in stream_subprocess(shlex.split(full_cmd),
+                                  timeout=TWINT_CLI_TIMEOUT):
+        # Skips messages of Twint
+        if not line.startswith('{'):
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            logger.warning(f'Invalid output of `{cmd}`: {line}')
 
 
 def query_twint_package(config, since: Optional[str] = None,
-                        until: Optional[str] = None) -> Iterator[Dict]:
+                        until: Optional[str] = None) -> List[Dict]:
     config.Pandas = True
     config.Hide_output = True
 
@@ -184,67 +309,138 @@ def query_twint_package(config, since: Optional[str] = None,
     if until:
         config.Until = until
 
-    twint.run.Search(config)
-    res_df = twint.storage.panda.Tweets_df
-    res_dict = res_df.to_dict('records')
-
-    for e in res_dict:
-        yield from format_twint_tweet(e)
+    with twint_lock:
+        twint.run.Search(config)
+        res_df = twint.storage.panda.Tweets_df
+        return res_df.to_dict('records')
 
 
-def query_user(username: str, *args, **kwargs) -> Iterator[Dict]:
+def query_user(username: str, *args, **kwargs) -> Iterable[Dict]:
     return query_twint_cli(f'twint -u {username} --timeline', *args, **kwargs)
 
 
-def query_mentions(username: str, *args, **kwargs) -> Iterator[Dict]:
+def query_mentions(username: str, *args, **kwargs) -> Iterable[Dict]:
     """Returns tweets that mention a username"""
     config = twint.Config()
     config.Search = f'@{username}'
     return query_twint_package(config, *args, **kwargs)
 
 
-def query_hashtag(hashtag: str, *args, **kwargs) -> Iterator[Dict]:
+def query_hashtag(hashtag: str, *args, **kwargs) -> Iterable[Dict]:
     config = twint.Config()
     config.Search = f'#{hashtag}'
     return query_twint_package(config, *args, **kwargs)
 
 
+# Queries by checkpoint key
+QUERIES = {
+    **{f'user:{e}': functools.partial(query_user, e) for e in USERNAMES},
+    **{f'mentions:{e}': functools.partial(query_mentions, e)
+       for e in USERNAMES},
+    **{f'hashtag:{e}': functools.partial(query_hashtag, e) for e in HASHTAGS},
+}  # type: Dict[str, Callable[..., Iterable[Dict]]]
+
+
+def run_query(key: str, since_id: Optional[int] = None, **kwargs
+              ) -> Iterator[Dict]:
+    """Yields the tweets found by a query, newer than `since_id`, as they
+    are found (by batches, to look up the tweets they reference together).
+    Once they are all yielded, the checkpoint of the query moves to the
+    newest one."""
+    assert checkpoints
+    raws = (e for e in QUERIES[key](**kwargs)
+            if since_id is None or int(e['id']) > since_id)
+    newest = None  # type: Optional[Dict]
+    for batch in iter_batches(raws, LOOKUP_BATCH_SIZE):
+        yield from format_twint_tweets(batch)
+        newest = max(batch + ([newest] if newest else []),
+                     key=lambda e: int(e['id']))
+
+    if newest:
+        checkpoint = {'id': str(newest['id']), 'date': newest['date']}
+        checkpoints.update(
+            key, lambda e: checkpoint
+            if e is None or int(e['id']) < int(checkpoint['id']) else e)
+
+
 def clean_up_text(text: str) -> str:
     text = text.strip(' ')
     text = text.strip('\n')
     return text
 
 
-def save_all(tweets: List[Dict]):
-    for tw in tweets:
-        save_as_json(tw)
+def save_if_new(tweet: Dict) -> bool:
+    """Saves a tweet, unless it is known (tweets can't be edited)"""
+    if seen_index().contains(tweet['url']):
+        return False
+    save_doc(tweet)
+    return True
+
+
+def get_jobs(n_days: Optional[int] = None) -> List[Job]:
+    """Queries to run: for each day of the last `n_days` if set (backfill),
+    else for the tweets newer than the checkpoint of each query"""
+    assert checkpoints
+    jobs = []
+    if n_days:
+        for since, until in get_date_intervals(n_days):
+            for key in QUERIES:
+                jobs.append(Job(f'{key} {since}', functools.partial(
+                    run_query, key, since=since, until=until)))
+        return jobs
+
+    since, _ = next(get_date_intervals(1))
+    for key in QUERIES:
+        checkpoint = checkpoints.get(key)
+        if checkpoint is None:
+            jobs.append(Job(f'{key} {since}', functools.partial(
+                run_query, key, since=since)))
+            continue
+        # Twint searches by day (in its own timezone), so we start the day
+        # before the checkpoint and skip older tweets by id
+        since_ = (datetime.strptime(checkpoint['date'][:10], '%Y-%m-%d')
+                  - timedelta(days=1)).strftime('%Y-%m-%d')
+        jobs.append(Job(f'{key} {since_}', functools.partial(
+            run_query, key, since_id=int(checkpoint['id']), since=since_)))
+    return jobs
 
 
 @click.command()
-@click.option('--n_days', type=int, default=1, nargs=1, show_default=True)
+@click.option('--n_days', type=int, default=None, nargs=1, show_default=True,
+              help='Backfill the last n days, instead of querying tweets newer '
+                   'than the last run')
+@click.option('--n_workers', type=int, default=4, nargs=1, show_default=True)
+@click.option('--n_retries', type=int, default=2, nargs=1, show_default=True)
 @click.option('--consumer_key', type=str, default=os.environ['RSP_TWITTER_CONSUMER_KEY'] if 'RSP_TWITTER_CONSUMER_KEY' in os.environ else None, nargs=1, show_default=False)
 @click.option('--consumer_secret', type=str, default=os.environ['RSP_TWITTER_CONSUMER_SECRET'] if 'RSP_TWITTER_CONSUMER_SECRET' in os.environ else None, nargs=1, show_default=False)
 @click.option('--access_token_key', type=str, default=os.environ['RSP_TWITTER_TOKEN_KEY'] if 'RSP_TWITTER_TOKEN_KEY' in os.environ else None, nargs=1, show_default=False)
 @click.option('--access_token_secret', type=str, default=os.environ['RSP_TWITTER_TOKEN_SECRET'] if 'RSP_TWITTER_TOKEN_SECRET' in os.environ else None, nargs=1, show_default=False)
-def main(n_days: int, *args, **kwargs):
-    global api  # pylint: disable=global-statement
+def main(n_days: Optional[int], n_workers: int, n_retries: int, *args,
+         **kwargs):
+    global api, checkpoints  # pylint: disable=global-statement
     api = twitter.Api(tweet_mode='extended', sleep_on_rate_limit=True,
                       *args, **kwargs)
-
+    checkpoints = Checkpoints.for_crawler('twitter')
+    # Loaded before workers start using them
+    seen_index()
+    get_tweet_cache()
+
+    # Queries run in worker threads, and tweets are saved from this thread as
+    # they arrive
+    scheduler = JobScheduler(n_workers=n_workers, n_retries=n_retries)
     count = 0
-    for since, until in tqdm(list(get_date_intervals(n_days))):
-        for username in USERNAMES:
-            res = list(query_user(username, since=since, until=until)) \
-                  + list(query_mentions(username, since=since, until=until))
-            count += len(res)
-            save_all(res)
-
-        for hashtag in HASHTAGS:
-            res = list(query_hashtag(hashtag, since=since, until=until))
-            count += len(res)
-            save_all(res)
-
-    logger.info(f'Retrieved {count} tweets')
+    n_new = 0
+    for _, tweet in tqdm(scheduler.run(get_jobs(n_days))):
+        count += 1
+        n_new += save_if_new(tweet)
+
+    # Only once the tweets they account for are saved
+    checkpoints.save()
+
+    logger.info(f'Retrieved {count} tweets ({n_new} new)')
+    if scheduler.failed:
+        logger.error(f'{len(scheduler.failed)} queries failed: '
+                     f'{", ".join(scheduler.failed)}')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,70 @@
+"""
+Converts the corpus between JSON files and segments (see `roam_sanity.corpus`),
+and compacts segments.
+"""
+
+import os
+import json
+from pathlib import Path
+from loguru import logger
+import click
+from tqdm import tqdm
+from roam_sanity.corpus import SegmentStore
+from roam_sanity.util import get_by_extension, doc_id, json_loads
+
+
+@click.group()
+@click.option('--data_path', type=str, default=os.environ['RSP_DATA_PATH'] if 'RSP_DATA_PATH' in os.environ else None, nargs=1, show_default=False)
+@click.pass_context
+def main(ctx: click.Context, data_path: str):
+    ctx.obj = Path(data_path)
+
+
+@main.command(name='import')
+@click.option('--remove', is_flag=True, default=False, help='Remove JSON files once they are in segments')
+@click.pass_obj
+def import_(data_path: Path, remove: bool):
+    """Appends JSON files to segments"""
+    store = SegmentStore(data_path)
+    imported = []
+    for path in tqdm(list(get_by_extension(data_path, 'json')), unit='doc'):
+        try:
+            with open(path, 'rb') as f:
+                store.append(json_loads(f.read()))
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f'Skipping {path}: {e!r}')
+            continue
+        imported.append(path)
+    store.flush()
+
+    if remove:
+        for path in imported:
+            path.unlink()
+    logger.info(f'Imported {len(imported)} documents')
+
+
+@main.command()
+@click.pass_obj
+def export(data_path: Path):
+    """Writes the latest version of each document as a JSON file"""
+    n_docs = 0
+    for doc in tqdm(SegmentStore(data_path).iter_docs(), unit='doc'):
+        dir_path = data_path / doc['source']
+        with open(dir_path / f'{doc_id(doc)}.json', 'w') as f:
+            json.dump(doc, f, sort_keys=True, indent='\t')
+        n_docs += 1
+    logger.info(f'Exported {n_docs} documents')
+
+
+@main.command()
+@click.pass_obj
+def compact(data_path: Path):
+    """Rewrites segments without superseded documents"""
+    store = SegmentStore(data_path)
+    for source in store.sources():
+        logger.info(f'Compacting `{source}`')
+        store.compact(source)
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,34 @@
+"""
+Serves the asynchronous app (`app/asgi.py`) with Uvicorn.
+Requires the `async` extra dependencies: `pip install -U -e .[async]`
+"""
+
+import os
+import sys
+from pathlib import Path
+import click
+import uvicorn
+
+APP_DIR = Path(__file__).resolve().parents[1] / 'app'
+
+
+@click.command()
+@click.option('--host', type=str, default='0.0.0.0', nargs=1, show_default=True)
+@click.option('--port', type=int, default=8000, nargs=1, show_default=True)
+@click.option('--workers', type=int, default=os.cpu_count() or 1, nargs=1, show_default=True, help='Number of worker processes')
+@click.option('--backlog', type=int, default=2048, nargs=1, show_default=True, help='Maximum number of pending connections')
+@click.option('--timeout_keep_alive', type=int, default=5, nargs=1, show_default=True)
+def main(host: str, port: int, workers: int, backlog: int,
+         timeout_keep_alive: int):
+    # Worker processes import the app from the `app` folder
+    sys.path.insert(0, str(APP_DIR))
+    os.environ['PYTHONPATH'] = os.pathsep.join(
+        [str(APP_DIR)] + [p for p in [os.environ.get('PYTHONPATH')] if p])
+
+    uvicorn.run('asgi:app', host=host, port=port, workers=workers,
+                backlog=backlog, timeout_keep_alive=timeout_keep_alive,
+                proxy_headers=True, log_level='info')
+
+
+if __name__ == '__main__':
+    main()
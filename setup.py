@@ -26,6 +26,19 @@ setup(
         'tqdm',
     ],
     extras_require={
+        'fast': [
+            'lxml',
+            'orjson',
+        ],
+        'embedded': [
+            'numpy',
+            'PyStemmer',
+        ],
+        'async': [  # requires Python 3.7 or later
+            'elasticsearch[async]>=7.8,<8',
+            'quart',
+            'uvicorn[standard]',
+        ],
         'crawl': [
             'bs4',
             'Markdown',